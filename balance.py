@@ -18,17 +18,36 @@
 
 import minqlx
 import requests
-import itertools
+import functools
+import concurrent.futures
+import bisect
+import heapq
 import threading
+import queue
+import array
+import operator
+import math
+import collections
 import random
 import time
 
 from minqlx.database import Redis
 
 RATING_KEY = "minqlx:players:{0}:ratings:{1}" # 0 == steam_id, 1 == short gametype.
+# Ratings fetched from the API, shared between servers using the same database.
+CACHED_RATINGS_KEY = "minqlx:players:{}:ratings_cache"
 MAX_ATTEMPTS = 3
+REQUEST_TIMEOUT = 5 # Seconds before giving up on a single API call.
+RETRY_BACKOFF = 0.5 # Seconds to wait after the first failed attempt. Doubles each attempt.
+COALESCE_WINDOW = 0.25 # Seconds to wait for more requests before making an API call.
+REQUEST_EXPIRE = 30 # Seconds a request can wait for the fetcher before it's given up on.
+SWEEP_INTERVAL = 60*5 # Seconds between each sweep of expired ratings from the cache.
 CACHE_EXPIRE = 60*30 # 30 minutes TTL.
+# Smallest cache size allowed, so that everyone on a full server always fits.
+MIN_CACHE_SIZE = 64
 DEFAULT_RATING = 1500
+# Ratings and games are kept in signed 32-bit arrays, so anything outside this is clamped.
+RATING_LIMIT = 2**31 - 1
 SUPPORTED_GAMETYPES = ("ca", "ctf", "dom", "ft", "tdm")
 # Externally supported game types. Used by !getrating for game types the API works with.
 EXT_SUPPORTED_GAMETYPES = ("ca", "ctf", "dom", "ft", "tdm", "duel", "ffa")
@@ -40,6 +59,10 @@ class balance(minqlx.Plugin):
         self.add_hook("round_countdown", self.handle_round_countdown)
         self.add_hook("round_start", self.handle_round_start)
         self.add_hook("vote_ended", self.handle_vote_ended)
+        self.add_hook("unload", self.handle_unload)
+        self.add_hook("player_connect", self.handle_player_connect)
+        self.add_hook("team_switch", self.handle_team_switch)
+        self.add_hook("new_game", self.handle_new_game)
         self.add_command(("setrating", "setelo"), self.cmd_setrating, 3, usage="<id> <rating>")
         self.add_command(("getrating", "getelo", "elo"), self.cmd_getrating, usage="<id> [gametype]")
         self.add_command(("remrating", "remelo"), self.cmd_remrating, 3, usage="<id>")
@@ -48,13 +71,10 @@ class balance(minqlx.Plugin):
         self.add_command("do", self.cmd_do, 1)
         self.add_command(("agree", "a"), self.cmd_agree)
         self.add_command(("ratings", "elos", "selo"), self.cmd_ratings)
+        self.add_command("ratingcache", self.cmd_ratingcache, 2)
 
-        self.ratings_lock = threading.RLock()
-        # Keys: steam_id - Items: {"ffa": {"elo": 123, "games": 321, "local": False}, ...}
-        self.ratings = {}
-        # Keys: request_id - Items: (players, callback, channel)
-        self.requests = {}
-        self.request_counter = itertools.count()
+        self.set_cvar_once("qlx_balanceCacheSize", "10000")
+        self.ratings = RatingStore(self.get_cvar("qlx_balanceCacheSize", int))
         self.suggested_pair = None
         self.suggested_agree = [False, False]
         self.in_countdown = False
@@ -64,10 +84,19 @@ class balance(minqlx.Plugin):
         self.set_cvar_once("qlx_balanceAuto", "1")
         self.set_cvar_once("qlx_balanceMinimumSuggestionDiff", "25")
         self.set_cvar_once("qlx_balanceApi", "elo")
+        self.set_cvar_once("qlx_balanceSharedCache", "1")
+        self.set_cvar_once("qlx_balancePrefetch", "1")
+        self.set_cvar_once("qlx_balanceObjective", "mean")
 
         self.use_local = self.get_cvar("qlx_balanceUseLocal", bool)
+        self.use_shared = self.get_cvar("qlx_balanceSharedCache", bool)
         self.api_url = "http://{}/{}/".format(self.get_cvar("qlx_balanceUrl"), self.get_cvar("qlx_balanceApi"))
 
+        # A single worker making all the API calls, merging requests that come in close together.
+        self.fetcher = RatingFetcher(self.api_url, self.fetch_ratings,
+            functools.partial(self.ratings.sweep, CACHE_EXPIRE))
+        self.fetcher.start()
+
     def handle_round_countdown(self, *args, **kwargs):
         if all(self.suggested_agree):
             # If we don't delay the switch a bit, the round countdown sound and
@@ -99,87 +128,151 @@ class balance(minqlx.Plugin):
                 self.add_request(players, self.callback_balance, minqlx.CHAT_CHANNEL)
             f()
 
-    @minqlx.thread
-    def fetch_ratings(self, players, request_id):
-        if not players:
-            return
+    def handle_player_connect(self, player):
+        self.prefetch([player])
+
+    def handle_team_switch(self, player, old_team, new_team):
+        if new_team != "spectator":
+            self.prefetch([player])
+
+    def handle_new_game(self):
+        # The game type might have changed with the map.
+        self.prefetch(self.players())
+
+    def handle_unload(self, plugin):
+        if plugin == self.__class__.__name__:
+            self.fetcher.stop()
 
+    def fetch_ratings(self, players):
+        """Called by the fetcher thread with the merged players of every request in a batch.
+        Keys are steam IDs and items are sets of the game types we need for that player.
+
+        """
         # We don't want to modify the actual dict, so we use a copy.
-        players = players.copy()
+        players = dict([(sid, gts.copy()) for sid, gts in players.items()])
 
         # Get local ratings if present in DB.
         if self.use_local:
             for steam_id in players.copy():
-                gt = players[steam_id]
-                key = RATING_KEY.format(steam_id, gt)
-                if key in self.db:
-                    with self.ratings_lock:
-                        if steam_id in self.ratings:
-                            self.ratings[steam_id][gt] = {"games": -1, "elo": int(self.db[key]), "local": True, "time": -1}
-                        else:
-                            self.ratings[steam_id] = {gt: {"games": -1, "elo": int(self.db[key]), "local": True, "time": -1}}
+                for gt in players[steam_id].copy():
+                    key = RATING_KEY.format(steam_id, gt)
+                    if key in self.db:
+                        self.ratings.set(steam_id, gt, int(self.db[key]), local=True)
+                        players[steam_id].discard(gt)
+                if not players[steam_id]:
                     del players[steam_id]
 
-        attempts = 0
-        last_status = 0
-        while attempts < MAX_ATTEMPTS:
-            attempts += 1
-            url = self.api_url + "+".join([str(sid) for sid in players])
-            res = requests.get(url)
-            last_status = res.status_code
-            if res.status_code != requests.codes.ok:
-                continue
-            
-            js = res.json()
-            if "players" not in js:
-                last_status = -1
-                continue
+        # Then check if another server or an earlier instance of us already fetched them.
+        if self.use_shared and players:
+            self.get_shared_ratings(players)
 
-            # Fill our ratings dict with the ratings we just got.
-            for p in js["players"]:
-                sid = int(p["steamid"])
-                del p["steamid"]
-                t = time.time()
-
-                with self.ratings_lock:
-                    if sid not in self.ratings:
-                        self.ratings[sid] = {}
-                    
-                    for gt in p:
-                        p[gt]["time"] = t
-                        p[gt]["local"] = False
-                        self.ratings[sid][gt] = p[gt]
-                        if self.ratings[sid][gt]["elo"] == 0 and self.ratings[sid][gt]["games"] == 0:
-                            self.ratings[sid][gt]["elo"] = DEFAULT_RATING
-                        
-                        if sid in players and gt == players[sid]:
-                            # The API gave us the game type we wanted, so we remove it.
-                            del players[sid]
-
-                    # Fill the rest of the game types the API didn't return but supports.
-                    for gt in SUPPORTED_GAMETYPES:
-                        if gt not in self.ratings[sid]:
-                            self.ratings[sid][gt] = {"games": -1, "elo": DEFAULT_RATING, "local": False, "time": time.time()}
-
-            # If the API didn't return all the players, we set them to the default rating.
-            for sid in players:
-                with self.ratings_lock:
-                    if sid not in self.ratings:
-                        self.ratings[sid] = {}
-                    self.ratings[sid][players[sid]] = {"games": -1, "elo": DEFAULT_RATING, "local": False, "time": time.time()}
-
-            break
+        if not players:
+            return requests.codes.ok
+
+        status, js = self.fetcher.request(players)
+        if status != requests.codes.ok:
+            return status
+
+        fetched = list(players)
+
+        # Fill our rating store with the ratings we just got.
+        t = time.time()
+        for p in js["players"]:
+            sid = int(p["steamid"])
+            del p["steamid"]
+
+            with self.ratings.lock:
+                for gt in p:
+                    if sid in players:
+                        # The API gave us the game type we wanted, so we remove it.
+                        players[sid].discard(gt)
+
+                    # Don't let the API overwrite ratings set with !setrating.
+                    old = self.ratings.get(sid, gt)
+                    if old and old.local:
+                        continue
+
+                    # The ratings are kept in integer arrays, so round whatever the API gives us.
+                    elo, games = int(round(p[gt]["elo"])), int(p[gt]["games"])
+                    if elo == 0 and games == 0:
+                        elo = DEFAULT_RATING
+                    self.ratings.set(sid, gt, elo, games, t)
+
+                # Fill the rest of the game types the API didn't return but supports.
+                for gt in SUPPORTED_GAMETYPES:
+                    if not self.ratings.has(sid, gt):
+                        self.ratings.set(sid, gt, DEFAULT_RATING, -1, t)
+
+        # If the API didn't return all the players, we set them to the default rating.
+        for sid in players:
+            for gt in players[sid]:
+                self.ratings.set(sid, gt, DEFAULT_RATING, -1, t)
+
+        if self.use_shared:
+            self.set_shared_ratings(fetched)
+
+        return requests.codes.ok
+
+    def get_shared_ratings(self, players):
+        """Fill our ratings with the ones in the shared cache that haven't expired yet,
+        removing the game types we found from *players*.
+
+        """
+        sids = list(players)
+        db = self.db.pipeline()
+        for sid in sids:
+            db.hgetall(CACHED_RATINGS_KEY.format(sid))
+        
+        now = time.time()
+        for sid, cached in zip(sids, db.execute()):
+            if not cached:
+                continue
 
-        if attempts == MAX_ATTEMPTS:
-            self.handle_ratings_fetched(request_id, last_status)
+            with self.ratings.lock:
+                for field in cached:
+                    gt, _, attr = field.partition(":")
+                    if attr != "time":
+                        continue
+                    t = float(cached[field])
+                    if now >= t + CACHE_EXPIRE:
+                        continue
+                    old = self.ratings.get(sid, gt)
+                    if old and old.local:
+                        continue
+
+                    elo = int(round(float(cached[gt + ":elo"])))
+                    self.ratings.set(sid, gt, elo, int(cached[gt + ":games"]), t)
+                    players[sid].discard(gt)
+
+            if not players[sid]:
+                del players[sid]
+
+    def set_shared_ratings(self, sids):
+        """Write the API ratings we have for the given players to the shared cache."""
+        db = self.db.pipeline()
+        with self.ratings.lock:
+            for sid in sids:
+                mapping = {}
+                for gt, rating in self.ratings.items(sid):
+                    if rating.local:
+                        continue
+                    mapping[gt + ":elo"] = rating.elo
+                    mapping[gt + ":games"] = rating.games
+                    mapping[gt + ":time"] = rating.time
+                if mapping:
+                    key = CACHED_RATINGS_KEY.format(sid)
+                    db.hmset(key, mapping)
+                    db.expire(key, CACHE_EXPIRE)
+        db.execute()
+
+    def handle_ratings_fetched(self, players, callback, channel, args, future):
+        if future.cancelled():
+            return
+        elif future.exception():
+            channel.reply("ERROR: Timed out while waiting for ratings.")
             return
 
-        self.handle_ratings_fetched(request_id, requests.codes.ok)
-
-    @minqlx.next_frame
-    def handle_ratings_fetched(self, request_id, status_code):
-        players, callback, channel, args = self.requests[request_id]
-        del self.requests[request_id]
+        status_code = future.result()
         if status_code != requests.codes.ok:
             # TODO: Put a couple of known errors here for more detailed feedback.
             channel.reply("ERROR {}: Failed to fetch ratings.".format(status_code))
@@ -187,24 +280,47 @@ class balance(minqlx.Plugin):
             callback(players, channel, *args)
 
     def add_request(self, players, callback, channel, *args):
-        req = next(self.request_counter)
-        self.requests[req] = players.copy(), callback, channel, args
+        """Get the ratings of the players and call *callback* with them on the main thread.
+        Returns a future that can be used to cancel the request.
+
+        """
+        request_players = players.copy()
 
-        # Only start a new thread if we need to make an API request.
+        # Only queue it up for the fetcher if we need to make an API request.
         if self.remove_cached(players):
-            self.fetch_ratings(players, req)
+            future = self.fetcher.submit(players)
         else:
-            # All players were cached, so we tell it to go ahead and call the callbacks.
-            self.handle_ratings_fetched(req, requests.codes.ok)
+            # All players were cached, so we can go ahead and call the callback.
+            future = concurrent.futures.Future()
+            future.set_result(requests.codes.ok)
+
+        # Done callbacks are called on the worker thread, so we wait for the next frame.
+        future.add_done_callback(minqlx.next_frame(functools.partial(
+            self.handle_ratings_fetched, request_players, callback, channel, args)))
+        return future
+
+    def prefetch(self, players):
+        """Get the ratings of players in the background before anyone asks for them,
+        so that the balancing commands can run straight from the cache.
+
+        """
+        game = self.game
+        if not game or not self.get_cvar("qlx_balancePrefetch", bool):
+            return
+
+        gt = game.type_short
+        if gt not in EXT_SUPPORTED_GAMETYPES:
+            return
+
+        players = self.remove_cached(dict([(p.steam_id, gt) for p in players]))
+        if players:
+            self.fetcher.submit(players)
 
     def remove_cached(self, players):
-        with self.ratings_lock:
+        with self.ratings.lock:
             for sid in players.copy():
-                gt = players[sid]
-                if sid in self.ratings and gt in self.ratings[sid]:
-                    t = self.ratings[sid][gt]["time"]
-                    if t == -1 or time.time() < t + CACHE_EXPIRE:
-                        del players[sid]
+                if self.ratings.fresh(sid, players[sid], CACHE_EXPIRE):
+                    del players[sid]
 
         return players
 
@@ -248,7 +364,7 @@ class balance(minqlx.Plugin):
         else:
             name = sid
         
-        channel.reply("{} has a rating of ^6{}^7 in {}.".format(name, self.ratings[sid][gametype]["elo"], gametype.upper()))
+        channel.reply("{} has a rating of ^6{}^7 in {}.".format(name, self.ratings.elo(sid, gametype), gametype.upper()))
 
     def cmd_setrating(self, player, msg, channel):
         if len(msg) < 3:
@@ -272,6 +388,9 @@ class balance(minqlx.Plugin):
         except ValueError:
             player.tell("Invalid rating.")
             return minqlx.RET_STOP_ALL
+        if abs(rating) > RATING_LIMIT:
+            player.tell("Ratings can't be larger than {}.".format(RATING_LIMIT))
+            return minqlx.RET_STOP_ALL
 
         if target_player:
             name = target_player.name
@@ -282,11 +401,9 @@ class balance(minqlx.Plugin):
         self.db[RATING_KEY.format(sid, gt)] = rating
 
         # If we have the player cached, set the rating.
-        with self.ratings_lock:
-            if sid in self.ratings and gt in self.ratings[sid]:
-                self.ratings[sid][gt]["elo"] = rating
-                self.ratings[sid][gt]["local"] = True
-                self.ratings[sid][gt]["time"] = -1
+        with self.ratings.lock:
+            if self.ratings.has(sid, gt):
+                self.ratings.set(sid, gt, rating, local=True)
 
         channel.reply("{}'s {} rating has been set to ^6{}^7.".format(name, gt.upper(), rating))
 
@@ -316,9 +433,7 @@ class balance(minqlx.Plugin):
         del self.db[RATING_KEY.format(sid, gt)]
 
         # If we have the player cached, remove the game type.
-        with self.ratings_lock:
-            if sid in self.ratings and gt in self.ratings[sid]:
-                del self.ratings[sid][gt]
+        self.ratings.remove(sid, gt)
 
         channel.reply("{}'s locally set {} rating has been deleted.".format(name, gt.upper()))
 
@@ -348,47 +463,53 @@ class balance(minqlx.Plugin):
                 self.add_request(d, self.callback_balance, channel)
                 return
 
-        # Start out by evening out the number of players on each team.
-        diff = len(teams["red"]) - len(teams["blue"])
-        if abs(diff) > 1:
-            if diff > 0:
-                for i in range(diff - 1):
-                    p = teams["red"].pop()
-                    p.put("blue")
-                    teams["blue"].append(p)
-            elif diff < 0:
-                for i in range(abs(diff) - 1):
-                    p = teams["blue"].pop()
-                    p.put("red")
-                    teams["red"].append(p)
-
-        # Start shuffling by looping through our suggestion function until
-        # there are no more switches that can be done to improve teams.
-        switch = self.suggest_switch(teams, gt)
-        if switch:
-            while switch:
-                p1 = switch[0][0]
-                p2 = switch[0][1]
-                self.switch(p1, p2)
-                teams["blue"].append(p1)
-                teams["red"].append(p2)
-                teams["blue"].remove(p2)
-                teams["red"].remove(p1)
-                switch = self.suggest_switch(teams, gt)
-            avg_red = self.team_average(teams["red"], gt)
-            avg_blue = self.team_average(teams["blue"], gt)
-            diff_rounded = abs(round(avg_red) - round(avg_blue)) # Round individual averages.
-            if round(avg_red) > round(avg_blue):
-                self.msg("^1{} ^7vs ^4{}^7 - DIFFERENCE: ^1{}"
-                    .format(round(avg_red), round(avg_blue), diff_rounded))
-            elif round(avg_red) < round(avg_blue):
-                self.msg("^1{} ^7vs ^4{}^7 - DIFFERENCE: ^4{}"
-                    .format(round(avg_red), round(avg_blue), diff_rounded))
-            else:
-                self.msg("^1{} ^7vs ^4{}^7 - Holy shit!"
-                    .format(round(avg_red), round(avg_blue)))
+        # The team that currently has more players keeps the extra one if the total is odd.
+        if len(teams["red"]) >= len(teams["blue"]):
+            red_size = (len(current) + 1) // 2
         else:
+            red_size = len(current) // 2
+
+        # Let the partition engine find the target teams before we move anyone.
+        sids = [p.steam_id for p in current]
+        ratings = self.ratings.elos(sids, gt)
+        games = self.ratings.games(sids, gt)
+        red_now = set(range(len(teams["red"])))
+        red_target, naive = partition(ratings, red_size, red_now, objective=self.objective(), games=games)
+
+        # Pair up players going in opposite directions so each pair takes a single switch.
+        to_blue = [current[i] for i in sorted(red_now - red_target)]
+        to_red = [current[i] for i in sorted(red_target - red_now)]
+        if not to_blue and not to_red:
             channel.reply("Teams are good! Nothing to balance.")
+            return True
+
+        for p1, p2 in zip(to_blue, to_red):
+            self.switch(p1, p2)
+        for p in to_blue[len(to_red):]:
+            p.put("blue")
+        for p in to_red[len(to_blue):]:
+            p.put("red")
+
+        avg_red = sum(ratings[i] for i in red_target) / red_size
+        avg_blue = (sum(ratings) - avg_red * red_size) / (len(current) - red_size)
+        diff_rounded = abs(round(avg_red) - round(avg_blue)) # Round individual averages.
+        if round(avg_red) > round(avg_blue):
+            self.msg("^1{} ^7vs ^4{}^7 - DIFFERENCE: ^1{}"
+                .format(round(avg_red), round(avg_blue), diff_rounded))
+        elif round(avg_red) < round(avg_blue):
+            self.msg("^1{} ^7vs ^4{}^7 - DIFFERENCE: ^4{}"
+                .format(round(avg_red), round(avg_blue), diff_rounded))
+        else:
+            self.msg("^1{} ^7vs ^4{}^7 - Holy shit!"
+                .format(round(avg_red), round(avg_blue)))
+
+        moves = len(to_blue) + len(to_red)
+        naive_moves = count_moves(red_now, naive)
+        if 2 * red_size == len(current):
+            naive_moves = min(naive_moves, len(current) - naive_moves)
+        saved = naive_moves - moves
+        if saved > 0:
+            self.msg("Moved ^6{}^7 players, ^6{}^7 fewer than needed for the plain best split.".format(moves, saved))
         return True
 
     def cmd_teams(self, player, msg, channel):
@@ -493,60 +614,54 @@ class balance(minqlx.Plugin):
                 self.add_request(d, self.callback_ratings, channel)
                 return
 
-        if teams["free"]:
-            free_sorted = sorted(teams["free"], key=lambda x: self.ratings[x.steam_id][gt]["elo"], reverse=True)
-            free = ", ".join(["{}: ^6{}^7".format(p.clean_name, self.ratings[p.steam_id][gt]["elo"]) for p in free_sorted])
-            channel.reply(free)
-        if teams["red"]:
-            red_sorted = sorted(teams["red"], key=lambda x: self.ratings[x.steam_id][gt]["elo"], reverse=True)
-            red = ", ".join(["{}: ^1{}^7".format(p.clean_name, self.ratings[p.steam_id][gt]["elo"]) for p in red_sorted])
-            channel.reply(red)
-        if teams["blue"]:
-            blue_sorted = sorted(teams["blue"], key=lambda x: self.ratings[x.steam_id][gt]["elo"], reverse=True)
-            blue = ", ".join(["{}: ^4{}^7".format(p.clean_name, self.ratings[p.steam_id][gt]["elo"]) for p in blue_sorted])
-            channel.reply(blue)
-        if teams["spectator"]:
-            spec_sorted = sorted(teams["spectator"], key=lambda x: self.ratings[x.steam_id][gt]["elo"], reverse=True)
-            spec = ", ".join(["{}: {}".format(p.clean_name, self.ratings[p.steam_id][gt]["elo"]) for p in spec_sorted])
-            channel.reply(spec)
+        sids = [p.steam_id for p in current]
+        elos = dict(zip(sids, self.ratings.elos(sids, gt)))
+        for team, color in (("free", "^6"), ("red", "^1"), ("blue", "^4"), ("spectator", "")):
+            if teams[team]:
+                team_sorted = sorted(teams[team], key=lambda x: elos[x.steam_id], reverse=True)
+                channel.reply(", ".join(["{}: {}{}^7".format(p.clean_name, color, elos[p.steam_id]) for p in team_sorted]))
+
+    def cmd_ratingcache(self, player, msg, channel):
+        """Shows how well the rating cache is doing, to help with sizing it."""
+        r = self.ratings
+        with r.lock:
+            lookups = r.hits + r.misses
+            hit_rate = round(r.hits / lookups * 100, 1) if lookups else 0
+            capacity = r.capacity if r.capacity else "unlimited"
+            channel.reply("Rating cache: ^6{}^7/^6{}^7 players, ^6{}%^7 hit rate ({} hits, {} misses)."
+                .format(len(r), capacity, hit_rate, r.hits, r.misses))
+            channel.reply("^6{}^7 players evicted, ^6{}^7 ratings expired.".format(r.evictions, r.expirations))
 
     def suggest_switch(self, teams, gametype):
         """Suggest a switch based on average team ratings."""
-        avg_red = self.team_average(teams["red"], gametype)
-        avg_blue = self.team_average(teams["blue"], gametype)
-        cur_diff = abs(avg_red - avg_blue)
-        min_diff = 999999
-        best_pair = None
-
-        for red_p in teams["red"]:
-            for blue_p in teams["blue"]:
-                r = teams["red"].copy()
-                b = teams["blue"].copy()
-                b.append(red_p)
-                r.remove(red_p)
-                r.append(blue_p)
-                b.remove(blue_p)
-                avg_red = self.team_average(r, gametype)
-                avg_blue = self.team_average(b, gametype)
-                diff = abs(avg_red - avg_blue)
-                if diff < min_diff:
-                    min_diff = diff
-                    best_pair = (red_p, blue_p)
-
-        if min_diff < cur_diff:
-            return (best_pair, cur_diff - min_diff)
-        else:
+        if not teams["red"] or not teams["blue"]:
             return None
 
+        red = [p.steam_id for p in teams["red"]]
+        blue = [p.steam_id for p in teams["blue"]]
+        red = player_vectors(self.ratings.elos(red, gametype), self.ratings.games(red, gametype))
+        blue = player_vectors(self.ratings.elos(blue, gametype), self.ratings.games(blue, gametype))
+        swap = best_swap(red, blue, self.objective())
+        if not swap:
+            return None
+
+        i, j, improvement = swap
+        return ((teams["red"][i], teams["blue"][j]), improvement)
+
+    def objective(self):
+        """Get the function the partition engine should score splits with."""
+        name = self.get_cvar("qlx_balanceObjective").lower()
+        if name not in OBJECTIVES:
+            self.logger.warning("Unknown balance objective \"{}\". Using \"mean\" instead.".format(name))
+            return objective_mean
+        return OBJECTIVES[name]
+
     def team_average(self, team, gametype):
         """Calculates the average rating of a team."""
-        avg = 0
-        if team:
-            for p in team:
-                avg += self.ratings[p.steam_id][gametype]["elo"]
-            avg /= len(team)
+        if not team:
+            return 0
 
-        return avg
+        return sum(self.ratings.elos([p.steam_id for p in team], gametype)) / len(team)
 
     def execute_suggestion(self):
         p1, p2 = self.suggested_pair
@@ -561,3 +676,686 @@ class balance(minqlx.Plugin):
         
         self.suggested_pair = None
         self.suggested_agree = [False, False]
+
+
+# ====================================================================
+#                            RATING STORE
+# ====================================================================
+
+class Rating:
+    """A snapshot of a player's rating in a game type."""
+    __slots__ = ("elo", "games", "time", "local")
+
+    def __init__(self, elo, games=-1, time=-1, local=False):
+        self.elo = elo
+        self.games = games
+        self.time = time
+        self.local = local
+
+    def __repr__(self):
+        return "Rating(elo={}, games={}, time={}, local={})".format(self.elo, self.games, self.time, self.local)
+
+# States a slot can be in within a game type.
+_ABSENT = 0
+_FETCHED = 1
+_LOCAL = 2
+
+class RatingStore:
+    """Keeps cached ratings in flat per-game type arrays instead of a dictionary per
+    player and game type. Every cached player gets a slot, which indexes the elo,
+    games, time and state arrays of every game type.
+
+    If *capacity* is non-zero, the least recently used players are evicted once there
+    are more than that many cached. Players with local ratings are never evicted.
+    Capacities below :data:`MIN_CACHE_SIZE` are raised to it, so that evictions never
+    hit players that are connected or still waiting on the API.
+
+    """
+    def __init__(self, capacity=0):
+        self.lock = threading.RLock()
+        self.capacity = max(capacity, MIN_CACHE_SIZE) if capacity else 0
+        # Keys: steam_id - Items: slot. Ordered from least to most recently used.
+        self.slots = collections.OrderedDict()
+        # Slots of evicted players, ready to be reused.
+        self.free = []
+        self.allocated = 0
+        # Keys: gametype - Items: (elo, games, time, state)
+        self.tables = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, steam_id):
+        return steam_id in self.slots
+
+    def _table(self, gametype):
+        table = self.tables.get(gametype)
+        if table is None:
+            table = (array.array("i"), array.array("i"), array.array("d"), bytearray())
+            self.tables[gametype] = table
+        # Tables are grown lazily, so that game types we rarely see don't take space.
+        missing = self.allocated - len(table[3])
+        if missing > 0:
+            table[0].extend([0] * missing)
+            table[1].extend([0] * missing)
+            table[2].extend([0.0] * missing)
+            table[3].extend(bytes(missing))
+        return table
+
+    def _state(self, slot, gametype):
+        table = self.tables.get(gametype)
+        if table is None or slot >= len(table[3]):
+            return _ABSENT
+        return table[3][slot]
+
+    def _is_pinned(self, slot):
+        return any(slot < len(t[3]) and t[3][slot] == _LOCAL for t in self.tables.values())
+
+    def _is_empty(self, slot):
+        return all(slot >= len(t[3]) or t[3][slot] == _ABSENT for t in self.tables.values())
+
+    def _release(self, steam_id):
+        slot = self.slots.pop(steam_id)
+        for table in self.tables.values():
+            if slot < len(table[3]):
+                table[3][slot] = _ABSENT
+        self.free.append(slot)
+
+    def _evict(self, keep):
+        excess = len(self.slots) - self.capacity
+        if not self.capacity or excess <= 0:
+            return
+
+        victims = []
+        for sid, slot in self.slots.items():
+            if len(victims) == excess:
+                break
+            elif sid != keep and not self._is_pinned(slot):
+                victims.append(sid)
+
+        for sid in victims:
+            self._release(sid)
+        self.evictions += len(victims)
+
+    def has(self, steam_id, gametype):
+        with self.lock:
+            slot = self.slots.get(steam_id)
+            return slot is not None and self._state(slot, gametype) != _ABSENT
+
+    def fresh(self, steam_id, gametype, ttl):
+        """Check if we have a rating that's younger than *ttl* seconds, and keep
+        track of the hit rate. Local ratings are always fresh.
+
+        """
+        with self.lock:
+            rating = self.get(steam_id, gametype)
+            if rating and (rating.local or time.time() < rating.time + ttl):
+                self.hits += 1
+                return True
+
+            self.misses += 1
+            return False
+
+    def get(self, steam_id, gametype):
+        """Get a :class:`Rating`, or None if the player isn't cached in that game type."""
+        with self.lock:
+            if not self.has(steam_id, gametype):
+                return None
+            self.slots.move_to_end(steam_id)
+            slot = self.slots[steam_id]
+            elo, games, t, state = self.tables[gametype]
+            return Rating(elo[slot], games[slot], t[slot], state[slot] == _LOCAL)
+
+    def items(self, steam_id):
+        """Get (gametype, :class:`Rating`) pairs for every game type a player is cached in."""
+        with self.lock:
+            return [(gt, self.get(steam_id, gt)) for gt in self.tables if self.has(steam_id, gt)]
+
+    def set(self, steam_id, gametype, elo, games=-1, time=-1, local=False):
+        with self.lock:
+            slot = self.slots.get(steam_id)
+            if slot is None:
+                if self.free:
+                    slot = self.free.pop()
+                else:
+                    slot = self.allocated
+                    self.allocated += 1
+                self.slots[steam_id] = slot
+            else:
+                self.slots.move_to_end(steam_id)
+
+            elo_a, games_a, time_a, state = self._table(gametype)
+            elo_a[slot] = max(-RATING_LIMIT, min(RATING_LIMIT, elo))
+            games_a[slot] = max(-RATING_LIMIT, min(RATING_LIMIT, games))
+            time_a[slot] = -1 if local else time
+            state[slot] = _LOCAL if local else _FETCHED
+            self._evict(steam_id)
+
+    def remove(self, steam_id, gametype):
+        with self.lock:
+            if self.has(steam_id, gametype):
+                slot = self.slots[steam_id]
+                self.tables[gametype][3][slot] = _ABSENT
+                if self._is_empty(slot):
+                    self._release(steam_id)
+
+    def sweep(self, ttl):
+        """Drop every fetched rating older than *ttl* seconds, freeing the slots
+        of players that have nothing left cached."""
+        expired_before = time.time() - ttl
+        with self.lock:
+            for _, _, t, state in self.tables.values():
+                for slot in range(len(state)):
+                    if state[slot] == _FETCHED and t[slot] < expired_before:
+                        state[slot] = _ABSENT
+                        self.expirations += 1
+
+            for sid in [sid for sid, slot in self.slots.items() if self._is_empty(slot)]:
+                self._release(sid)
+
+    def elo(self, steam_id, gametype):
+        return self.elos([steam_id], gametype)[0]
+
+    def elos(self, steam_ids, gametype):
+        """Gather the ratings of several players at once. Every player needs to
+        be cached in the game type, else we raise a KeyError.
+
+        """
+        return self._gather(steam_ids, gametype, 0)
+
+    def games(self, steam_ids, gametype):
+        """Like :meth:`elos`, but for the number of games played."""
+        return self._gather(steam_ids, gametype, 1)
+
+    def _gather(self, steam_ids, gametype, column):
+        if not steam_ids:
+            return []
+
+        with self.lock:
+            slots = [self.slots[sid] for sid in steam_ids]
+            table = self.tables.get(gametype)
+            if table is None:
+                raise KeyError(gametype)
+            state = table[3]
+            for sid, slot in zip(steam_ids, slots):
+                if slot >= len(state) or state[slot] == _ABSENT:
+                    raise KeyError(sid)
+                self.slots.move_to_end(sid)
+            values = operator.itemgetter(*slots)(table[column])
+
+        if len(slots) == 1:
+            return [values]
+        return list(values)
+
+# ====================================================================
+#                          PARTITION ENGINE
+# ====================================================================
+
+# Lobbies up to this many players are partitioned exactly, or close to it with objectives
+# other than the mean. See EXACT_PAIR_LIMIT.
+EXACT_PARTITION_LIMIT = 16
+# Upper bound on the number of splits the exact search scores with objectives other
+# than the mean, which can't skip as many of them.
+EXACT_PAIR_LIMIT = 128
+# Upper bound on the number of swap passes done by the local search.
+LOCAL_SEARCH_PASSES = 64
+# How much worse a split can score and still be picked if it takes fewer moves.
+MOVE_TOLERANCE = 1
+# Rating points added per point of difference between the teams' standard deviations.
+SPREAD_WEIGHT = 0.5
+# Rating points added per unit of difference between the teams' average log(1 + games played).
+GAMES_WEIGHT = 25
+
+# Objectives score a split from the stats of both teams, each being a tuple of
+# (players, sum of ratings, sum of squared ratings, sum of log(1 + games)). Lower is
+# better. They can never score a split lower than its average rating difference,
+# which is what lets the exact search skip most splits without scoring them.
+
+def objective_mean(a, b):
+    """Only the difference between the average ratings."""
+    return abs(a[1] / a[0] - b[1] / b[0])
+
+def objective_spread(a, b):
+    """Also keep a team of one strong and several weak players from being
+    considered equal to a team of average players."""
+    return objective_mean(a, b) + SPREAD_WEIGHT * abs(_deviation(a) - _deviation(b))
+
+def objective_games(a, b):
+    """Also even out how experienced the teams are."""
+    return objective_spread(a, b) + GAMES_WEIGHT * abs(a[3] / a[0] - b[3] / b[0])
+
+OBJECTIVES = {"mean": objective_mean, "spread": objective_spread, "games": objective_games}
+
+def _deviation(stats):
+    n, s, sq = stats[0], stats[1], stats[2]
+    return math.sqrt(max(sq / n - (s / n) ** 2, 0))
+
+def player_vectors(ratings, games=None):
+    """Precompute (rating, rating squared, log(1 + games)) for every player."""
+    if games is None:
+        games = [0] * len(ratings)
+    return [(r, r * r, math.log1p(max(g, 0))) for r, g in zip(ratings, games)]
+
+def team_stats(vectors, team):
+    s = sq = g = 0
+    for i in team:
+        r, r2, e = vectors[i]
+        s += r
+        sq += r2
+        g += e
+    return (len(team), s, sq, g)
+
+def partition(ratings, size, current=(), tolerance=MOVE_TOLERANCE, objective=objective_mean, games=None):
+    """Split the players into a team of *size* and a team of the rest, scoring the
+    splits with *objective*, which by default looks at the average ratings only.
+
+    *ratings* and *games* are lists with the ratings and number of games of the players,
+    and *current* is a collection of indices into them making up the first team as it is
+    now. Any split scoring within *tolerance* of the best one is considered just as good,
+    in which case we pick the one that takes the fewest moves to get to from *current*.
+
+    Only :func:`objective_mean` is guaranteed to find the best split. Other objectives
+    look at a bounded number of the most promising splits, so they can settle for a
+    slightly worse one.
+
+    Returns a tuple of two sets of indices making up the first team: the one we picked,
+    and the best split we found without taking the current teams into account.
+
+    """
+    n = len(ratings)
+    current = set(current)
+    if not 0 < size < n:
+        team = set(range(size))
+        return team, team
+
+    vectors = player_vectors(ratings, games)
+    if n <= EXACT_PARTITION_LIMIT:
+        best, naive = _partition_exact(vectors, size, current, tolerance, objective)
+    else:
+        best, naive = _partition_local(vectors, size, current, tolerance, objective)
+
+    # With even teams, swapping the colors of a split doesn't change how good it is.
+    if 2 * size == n:
+        flipped = set(range(n)) - best
+        if count_moves(current, flipped) < count_moves(current, best):
+            best = flipped
+
+    return best, naive
+
+def count_moves(current, target):
+    """The number of players that need to change teams to get from one split to another."""
+    return len(current ^ set(target))
+
+def best_swap(team_a, team_b, objective=objective_mean):
+    """Find the single swap between two teams that improves the split the most. The teams
+    are lists of player vectors. Returns ``(index_a, index_b, improvement)`` or None if
+    no swap helps.
+
+    """
+    a = team_stats(team_a, range(len(team_a)))
+    b = team_stats(team_b, range(len(team_b)))
+    cur_score = objective(a, b)
+    best = None
+    best_score = cur_score
+    for i, va in enumerate(team_a):
+        for j, vb in enumerate(team_b):
+            score = objective(_moved(a, va, vb), _moved(b, vb, va))
+            if score < best_score:
+                best_score = score
+                best = (i, j)
+
+    if best is None:
+        return None
+
+    return best + (cur_score - best_score,)
+
+def _moved(stats, leaving, joining):
+    return (stats[0], stats[1] - leaving[0] + joining[0], stats[2] - leaving[1] + joining[1],
+        stats[3] - leaving[2] + joining[2])
+
+def _subsets(vectors, current=()):
+    """Enumerate every subset of the players, grouped by size, as lists of
+    (sum, sum of squares, sum of log games, mask, kept) sorted by sum, where kept
+    is how many of the indices in *current* the subset has."""
+    by_size = [[] for _ in range(len(vectors) + 1)]
+    subsets = [(0, 0, 0, 0, 0, 0)]
+    for bit, (r, r2, e) in enumerate(vectors):
+        flag = 1 << bit
+        k = 1 if bit in current else 0
+        subsets += [(s + r, sq + r2, g + e, m | flag, c + 1, kept + k) for s, sq, g, m, c, kept in subsets]
+    for s, sq, g, m, c, kept in subsets:
+        by_size[c].append((s, sq, g, m, kept))
+    for group in by_size:
+        group.sort()
+    return by_size
+
+def _partition_exact(vectors, size, current, tolerance, objective):
+    """Meet-in-the-middle: enumerate both halves of the lobby separately and pair up
+    each subset of the left half with subsets of the right half.
+
+    Since no objective scores a split lower than its average difference, we visit the
+    pairs in order of average difference, walking outwards from the right subset that
+    would make the averages equal for every left subset at once, until none of the
+    remaining pairs can get within the tolerance of the best so far. This is exact for
+    :func:`objective_mean`. Other objectives stop after :data:`EXACT_PAIR_LIMIT` pairs,
+    so for those it's a heuristic that can miss the best split, in exchange for
+    staying fast.
+
+    """
+    n = len(vectors)
+    half = n // 2
+    left = _subsets(vectors[:half], current)
+    right = _subsets(vectors[half:], {i - half for i in current})
+    right_sums = [[entry[0] for entry in group] for group in right]
+    total = team_stats(vectors, range(n))
+    # The average difference is |sum_a - target| * scale.
+    target = total[1] * size / n
+    scale = n / (size * (n - size))
+    # With even teams, a split and its flipped colors are the same split, so we only
+    # look at the ones that put the first player in the first team.
+    symmetric = 2 * size == n
+
+    if objective is objective_mean:
+        # The score is the average difference, so we don't need to build the stats. The
+        # first pair is the best one, so we only go on for as long as there are pairs
+        # within the tolerance.
+        limit = None
+        def score(l, r):
+            return abs(l[0] + r[0] - target) * scale
+    else:
+        limit = EXACT_PAIR_LIMIT
+        def score(l, r):
+            a = (size, l[0] + r[0], l[1] + r[1], l[2] + r[2])
+            b = (n - size, total[1] - a[1], total[2] - a[2], total[3] - a[3])
+            return objective(a, b)
+
+    # One walker in each direction for every left subset, as
+    # [average difference, id, index, step, left subset, right entries, right sums, gap].
+    walkers = []
+    for count, group in enumerate(left):
+        need = size - count
+        if not 0 <= need < len(right) or not right[need]:
+            continue
+        entries, sums = right[need], right_sums[need]
+        for l in group:
+            if symmetric and not l[3] & 1:
+                continue
+            gap = target - l[0]
+            k = bisect.bisect_left(sums, gap)
+            if k > 0:
+                walkers.append([(gap - sums[k - 1]) * scale, len(walkers), k - 1, -1, l, entries, sums, gap])
+            if k < len(sums):
+                walkers.append([(sums[k] - gap) * scale, len(walkers), k, 1, l, entries, sums, gap])
+    heapq.heapify(walkers)
+
+    best_score = None
+    naive = None
+    scored = []
+    while walkers and len(scored) != limit:
+        walker = walkers[0]
+        if best_score is not None and walker[0] > best_score + tolerance + 1e-9:
+            break
+        _, _, j, step, l, entries, sums, gap = walker
+        r = entries[j]
+        s = score(l, r)
+        scored.append((s, l, r))
+        if best_score is None or s < best_score:
+            best_score = s
+            naive = (l, r)
+
+        j += step
+        if 0 <= j < len(sums):
+            walker[0] = abs(sums[j] - gap) * scale
+            walker[2] = j
+            heapq.heapreplace(walkers, walker)
+        else:
+            heapq.heappop(walkers)
+
+    # Then pick the split within the tolerance that keeps the most players where they are.
+    allowed = best_score + tolerance + 1e-9
+    best_key = None
+    best = naive
+    for s, l, r in scored:
+        if s > allowed:
+            continue
+        kept = l[4] + r[4]
+        if symmetric:
+            # The flipped split keeps the rest of the current first team.
+            kept = max(kept, len(current) - kept)
+        key = (kept, -s)
+        if best_key is None or key > best_key:
+            best_key = key
+            best = (l, r)
+
+    def to_team(pair):
+        left_mask, right_mask = pair[0][3], pair[1][3]
+        team = {i for i in range(half) if left_mask >> i & 1}
+        team.update(half + i for i in range(n - half) if right_mask >> i & 1)
+        return team
+
+    return to_team(best), to_team(naive)
+
+def _partition_local(vectors, size, current, tolerance, objective):
+    """Bounded local search for lobbies too large to solve exactly. We search from
+    both a greedy largest-first split and the current teams, preferring the latter
+    unless the former scores better by more than *tolerance*. If the current first
+    team isn't of *size*, we start from the fewest moves that make it so."""
+    n = len(vectors)
+    greedy = set()
+    sum_a = sum_b = 0
+    count_b = 0
+    for i in sorted(range(n), key=lambda i: vectors[i][0], reverse=True):
+        # Give each player to whichever team is lower relative to its size, if it has room.
+        if len(greedy) < size and (count_b == n - size or sum_a / size <= sum_b / (n - size)):
+            greedy.add(i)
+            sum_a += vectors[i][0]
+        else:
+            sum_b += vectors[i][0]
+            count_b += 1
+
+    naive, naive_score = _improve(vectors, greedy, objective)
+    best, best_score = _improve(vectors, _resize(vectors, current, size, objective), objective,
+        naive_score + tolerance)
+    if best_score > naive_score + tolerance + 1e-9:
+        best = naive
+
+    return best, naive
+
+def _resize(vectors, team, size, objective):
+    """Move players into or out of *team* one at a time until it has *size* players,
+    each time picking the player that leaves the best split."""
+    team = set(team)
+    others = set(range(len(vectors))) - team
+    a = team_stats(vectors, team)
+    b = team_stats(vectors, others)
+    while len(team) != size:
+        if len(team) > size:
+            source, target, sign = team, others, -1
+        else:
+            source, target, sign = others, team, 1
+        best = None
+        for i in source:
+            r, r2, e = vectors[i]
+            moved_a = (a[0] + sign, a[1] + sign * r, a[2] + sign * r2, a[3] + sign * e)
+            moved_b = (b[0] - sign, b[1] - sign * r, b[2] - sign * r2, b[3] - sign * e)
+            s = objective(moved_a, moved_b)
+            if best is None or s < best[0]:
+                best = (s, i, moved_a, moved_b)
+        _, i, a, b = best
+        source.remove(i)
+        target.add(i)
+
+    return team
+
+def _improve(vectors, team, objective, good_enough=0):
+    """Repeatedly apply the best single swap until nothing improves the split, or
+    until it scores *good_enough*. Returns the team and its score."""
+    others = set(range(len(vectors))) - team
+    a = team_stats(vectors, team)
+    b = team_stats(vectors, others)
+    score = objective(a, b)
+    for _ in range(LOCAL_SEARCH_PASSES):
+        if score <= good_enough:
+            break
+        swap = None
+        for i in team:
+            vi = vectors[i]
+            for j in others:
+                vj = vectors[j]
+                s = objective(_moved(a, vi, vj), _moved(b, vj, vi))
+                if s < score - 1e-9:
+                    score = s
+                    swap = (i, j)
+        if swap is None:
+            break
+        i, j = swap
+        a = _moved(a, vectors[i], vectors[j])
+        b = _moved(b, vectors[j], vectors[i])
+        team.remove(i)
+        team.add(j)
+        others.remove(j)
+        others.add(i)
+
+    return team, score
+
+# ====================================================================
+#                           RATING FETCHER
+# ====================================================================
+
+class RatingFetcher(threading.Thread):
+    """A long-lived worker that makes all API calls for the plugin. Requests queued within
+    :data:`COALESCE_WINDOW` of each other are merged into a single call, after which every
+    waiting request's future gets the status code of that call as its result.
+
+    Requests that are cancelled before the worker gets to them are skipped, and requests
+    that have been waiting for more than :data:`REQUEST_EXPIRE` seconds are failed with a
+    :class:`concurrent.futures.TimeoutError`.
+
+    """
+    def __init__(self, url, handler, sweeper=None):
+        super().__init__(daemon=True)
+        self.url = url
+        self.handler = handler
+        self.sweeper = sweeper
+        self.last_sweep = time.time()
+        self.session = requests.Session()
+        self.queue = queue.Queue()
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.sweep()
+            try:
+                batch = [self.queue.get(timeout=SWEEP_INTERVAL)]
+            except queue.Empty:
+                continue
+            if batch[0] is None:
+                break
+
+            # Give other requests a moment to come in so they can share the API call.
+            time.sleep(COALESCE_WINDOW)
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            players = {}
+            futures = []
+            now = time.time()
+            for item in batch:
+                if item is None:
+                    self.stop_event.set()
+                    continue
+                request_players, future, queued = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                elif now - queued > REQUEST_EXPIRE:
+                    future.set_exception(concurrent.futures.TimeoutError())
+                    continue
+                for sid, gt in request_players.items():
+                    players.setdefault(sid, set()).add(gt)
+                futures.append(future)
+
+            if not futures:
+                continue
+
+            try:
+                status = self.handler(players)
+            except Exception:
+                minqlx.log_exception()
+                status = -1
+
+            for future in futures:
+                future.set_result(status)
+
+        self.cancel_pending()
+        self.session.close()
+
+    def stop(self):
+        self.stop_event.set()
+        self.queue.put(None)
+
+    def cancel_pending(self):
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[1].cancel()
+
+    def sweep(self):
+        if self.sweeper and time.time() - self.last_sweep >= SWEEP_INTERVAL:
+            self.last_sweep = time.time()
+            try:
+                self.sweeper()
+            except Exception:
+                minqlx.log_exception()
+
+    def submit(self, players):
+        """Queue up a dictionary of steam_id -> gametype. Returns a future whose
+        result is the status code, set once the ratings are in.
+
+        """
+        future = concurrent.futures.Future()
+        self.queue.put((players.copy(), future, time.time()))
+        return future
+
+    def request(self, players):
+        """Get the ratings of a number of players in one API call, retrying with
+        an exponential backoff. Returns the status code and the decoded JSON.
+
+        """
+        url = self.url + "+".join([str(sid) for sid in players])
+        last_status = 0
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+            try:
+                res = self.session.get(url, timeout=REQUEST_TIMEOUT)
+            except requests.exceptions.RequestException:
+                last_status = -1
+                continue
+
+            last_status = res.status_code
+            if res.status_code != requests.codes.ok:
+                continue
+
+            try:
+                js = res.json()
+            except ValueError:
+                js = {}
+            if "players" not in js:
+                last_status = -1
+                continue
+
+            return requests.codes.ok, js
+
+        return last_status, None
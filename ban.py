@@ -18,12 +18,51 @@
 
 import minqlx
 import datetime
+import ipaddress
+import threading
+import json
+import os.path
 import time
+import uuid
 import re
 
 LENGTH_REGEX = re.compile(r"(?P<number>[0-9]+) (?P<scale>seconds?|minutes?|hours?|days?|weeks?|months?|years?)")
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 PLAYER_KEY = "minqlx:players:{}"
+# Hash with the participants and leavers of a finished game, by match GUID.
+GAME_KEY = "minqlx:games:{}"
+# Days game records and the per-player games they're referenced from are kept at least.
+RECORD_RETENTION = 90
+# Sorted set of steam IDs by the share of their games they've left, for those that
+# have played enough games to be banned for it.
+LEAVERS_KEY = "minqlx:leavers"
+# Seconds a player's games completed and left are cached, in case other servers add to them.
+LEAVE_CACHE_TTL = 600
+# Seconds before the leaver ban cvars are read again.
+CVAR_REFRESH = 10
+
+# Sorted set of steam IDs with active bans, scored by when their longest ban expires.
+BANS_KEY = "minqlx:bans"
+# Set once BANS_KEY has been built from the bans of every player. BANS_KEY itself goes
+# away whenever the last active ban expires, so it can't tell us that on its own.
+BANS_INDEXED_KEY = "minqlx:bans:indexed"
+# Sorted set of banned networks in CIDR notation, scored by when the ban expires.
+# The details of each are in a hash at IPBANS_KEY:<network>.
+IPBANS_KEY = "minqlx:ipbans"
+# Channel every server publishes to when it bans or unbans someone.
+BANS_CHANNEL = "minqlx:bans:updates"
+# Seconds to wait before listening again after losing the connection.
+LISTEN_RETRY = 5
+# Seconds to wait before loading the bans again after failing to.
+LOAD_RETRY = 10
+# Held by the server compacting the bans, so that only one does it per interval.
+COMPACT_LOCK_KEY = "minqlx:bans:compaction"
+# Number of ban sets read and compacted per pipeline.
+COMPACT_BATCH = 500
+# Number of ban sets, or lines, exported or imported per pipeline.
+TRANSFER_BATCH = 500
+# Directory in fs_homepath bans are exported to and imported from.
+TRANSFER_DIR = "bans"
 
 class ban(minqlx.Plugin):
     def __init__(self):
@@ -35,20 +74,49 @@ class ban(minqlx.Plugin):
         self.add_hook("game_start", self.handle_game_start)
         self.add_hook("game_end", self.handle_game_end)
         self.add_hook("team_switch", self.handle_team_switch)
+        self.add_hook("new_game", self.handle_new_game)
+        self.add_hook("unload", self.handle_unload)
         self.add_command("ban", self.cmd_ban, 2, usage="<id> <length> seconds|minutes|hours|days|... [reason]")
         self.add_command("unban", self.cmd_unban, 2, usage="<id>")
+        self.add_command("banip", self.cmd_banip, 2, usage="<id|ip|network> <length> seconds|minutes|hours|days|... [reason]")
+        self.add_command("unbanip", self.cmd_unbanip, 2, usage="<ip|network>")
         self.add_command("checkban", self.cmd_checkban, usage="<id>")
         self.add_command("forgive", self.cmd_forgive, 2, usage="<id> [leaves_to_forgive]")
+        self.add_command("leavers", self.cmd_leavers, usage="[amount]")
+        self.add_command("compactbans", self.cmd_compactbans, 5)
+        self.add_command("banexport", self.cmd_banexport, 5, usage="[file]")
+        self.add_command("banimport", self.cmd_banimport, 5, usage="[file]")
 
         # Cvars.
         self.set_cvar_once("qlx_leaverBan", "0")
         self.set_cvar_limit_once("qlx_leaverBanThreshold", "0.63", "0", "1")
         self.set_cvar_limit_once("qlx_leaverBanWarnThreshold", "0.78", "0", "1")
         self.set_cvar_once("qlx_leaverBanMinimumGames", "15")
+        self.set_cvar_once("qlx_leaverBanWindow", "0")
+        self.set_cvar_once("qlx_banCompactInterval", "24")
 
-        # List of players playing that could potentially be considered leavers.
-        self.players_start = []
+        # Players playing that could potentially be considered leavers, by steam ID.
+        self.players_start = {}
         self.pending_warnings = {}
+
+        self.leaver_settings = None
+        self.leaver_settings_time = 0
+        # Games completed and left by steam ID, as ((completed, left), window, time read).
+        self.leave_cache = {}
+        # Held while bans are being exported or imported.
+        self.transfer_lock = threading.Lock()
+
+        # Active bans by steam ID, as (expires, reason, timestamp). Kept in sync with
+        # the other servers using the same database through BANS_CHANNEL.
+        self.bans = {}
+        # Banned networks, with the same kind of items as above.
+        self.ip_bans = PrefixIndex()
+        # Until the above are loaded, bans are looked up in the database instead.
+        self.bans_loaded = False
+        self.server_id = uuid.uuid4().hex
+        self.ban_listener = BanListener(self.db, BANS_CHANNEL, self.handle_ban_update)
+        self.ban_listener.start()
+        self.load_bans()
     
     def handle_player_connect(self, player):
         status = self.leave_status(player.steam_id)
@@ -68,6 +136,15 @@ class ban(minqlx.Plugin):
             else:
                 return "You are banned until {}.".format(expires)
 
+        # Check if the player's address falls within a banned network.
+        banned = self.is_ip_banned(player.ip)
+        if banned and not self.db.has_permission(player.steam_id, 5):
+            expires, reason = banned
+            if reason:
+                return "You are banned until {}: {}".format(expires, reason)
+            else:
+                return "You are banned until {}.".format(expires)
+
     @minqlx.delay(4)
     def handle_player_loaded(self, player):
         # Update first, since player might be gone in those 4 seconds.
@@ -82,8 +159,48 @@ class ban(minqlx.Plugin):
     def handle_player_disconnect(self, player, reason):
         # Allow people to disconnect without getting a leave if teams are uneven.
         teams = self.teams()
-        if len(teams["red"] + teams["blue"]) % 2 != 0 and player in self.players_start:
-            self.players_start.remove(player)
+        if len(teams["red"] + teams["blue"]) % 2 != 0:
+            self.players_start.pop(player.steam_id, None)
+
+    def handle_new_game(self):
+        # Pick up changes to the cvars between games.
+        self.leaver_settings = None
+        # The counts don't depend on the cvars, so only drop the ones that are too old.
+        now = time.time()
+        for steam_id, cached in list(self.leave_cache.items()):
+            if now - cached[2] >= LEAVE_CACHE_TTL:
+                del self.leave_cache[steam_id]
+        self.compact(scheduled=True)
+
+    def handle_unload(self, plugin):
+        if plugin == self.__class__.__name__:
+            self.ban_listener.stop()
+
+    def handle_ban_update(self, data):
+        """Called by the listener thread when a server bans or unbans someone."""
+        server_id, target = data.split()
+        if server_id != self.server_id:
+            self.refresh_ban(target)
+
+    def refresh_ban(self, target):
+        """Read the bans on a steam ID or network from the database again."""
+        if "/" in target:
+            network = ipaddress.ip_network(target)
+            ban = self.fetch_ip_bans([target]).get(target)
+            if ban:
+                self.ip_bans.add(network, ban)
+                self.kick_banned_network(network, *ban[:2])
+            else:
+                self.ip_bans.remove(network)
+            return
+
+        steam_id = int(target)
+        ban = self.fetch_bans([steam_id]).get(steam_id)
+        if ban:
+            self.bans[steam_id] = ban
+            self.kick_banned(steam_id, *ban[:2])
+        else:
+            self.bans.pop(steam_id, None)
 
     def handle_game_countdown(self):
         if self.get_cvar("qlx_leaverBan", bool):
@@ -94,45 +211,58 @@ class ban(minqlx.Plugin):
     @minqlx.delay(1)
     def handle_game_start(self, game):
         teams = self.teams()
-        self.players_start = teams["red"] + teams["blue"]
+        self.players_start = dict((p.steam_id, p) for p in teams["red"] + teams["blue"])
 
     def handle_game_end(self, data):
         if data["ABORTED"]:
-            self.players_start = []
+            self.players_start = {}
             return
 
         teams = self.teams()
-        players_end = teams["red"] + teams["blue"]
-        leavers = []
-
-        for player in self.players_start.copy():
-            if player not in players_end:
-                # Populate player list.
-                leavers.append(player)
-                # Remove leavers from initial list so we can use it to award games completed.
-                self.players_start.remove(player)
+        players_end = set(p.steam_id for p in teams["red"] + teams["blue"])
+        leavers = [p for sid, p in self.players_start.items() if sid not in players_end]
+        completed = [sid for sid in self.players_start if sid in players_end]
+        self.players_start = {}
 
+        # Keep a record of the game, so that leaves can be looked at over a window of time.
+        now = time.time()
+        match_id = data.get("MATCH_GUID") or uuid.uuid4().hex
+        window = self.get_cvar("qlx_leaverBanWindow", float)
+        retention = 86400 * max(RECORD_RETENTION, window)
         db = self.db.pipeline()
-        for player in self.players_start:
-            db.incr(PLAYER_KEY.format(player.steam_id) + ":games_completed")
+        db.hmset(GAME_KEY.format(match_id), {"timestamp": now, "gametype": data.get("GAME_TYPE", ""),
+            "map": data.get("MAP", ""), "participants": " ".join(str(sid) for sid in completed),
+            "leavers": " ".join(str(p.steam_id) for p in leavers)})
+        db.expire(GAME_KEY.format(match_id), int(retention))
+        for sid in completed:
+            db.incr(PLAYER_KEY.format(sid) + ":games_completed")
+            db.zadd(PLAYER_KEY.format(sid) + ":games", now, match_id)
+            db.zremrangebyscore(PLAYER_KEY.format(sid) + ":games", "-inf", now - retention)
         for player in leavers:
             db.incr(PLAYER_KEY.format(player.steam_id) + ":games_left")
-        db.execute()
+            db.zadd(PLAYER_KEY.format(player.steam_id) + ":leaves", now, match_id)
+            db.zremrangebyscore(PLAYER_KEY.format(player.steam_id) + ":leaves", "-inf", now - retention)
+        # Read back the new counts to keep the leaver ranking up to date.
+        steam_ids = completed + [p.steam_id for p in leavers]
+        for sid in steam_ids:
+            self.leave_cache.pop(sid, None)
+            self.queue_leave_counts(db, sid, window)
+        res = db.execute()[-2 * len(steam_ids):]
+        self.rank_leavers(zip(steam_ids, res[::2], res[1::2]))
 
         if leavers:
             self.msg("^7Leavers: ^6{}".format(" ".join([p.clean_name for p in leavers])))
-            self.players_start = []
 
     def handle_team_switch(self, player, old_team, new_team):
         # Allow people to spectate without getting a leave if teams are uneven.
         if (old_team == "red" or old_team == "blue") and new_team == "spectator":
             teams = self.teams()
-            if len(teams["red"] + teams["blue"]) % 2 == 0 and player in self.players_start:
-                self.players_start.remove(player)
+            if len(teams["red"] + teams["blue"]) % 2 == 0:
+                self.players_start.pop(player.steam_id, None)
         # Add people to the list of participating players if they join mid-game.
         if (old_team == "spectator" and (new_team == "red" or new_team == "blue") and
-         self.game.state == "in_progress" and player not in self.players_start):
-            self.players_start.append(player)
+         self.game.state == "in_progress" and player.steam_id not in self.players_start):
+            self.players_start[player.steam_id] = player
 
     def cmd_ban(self, player, msg, channel):
         """Bans a player temporarily. A very long period works for all intents and
@@ -172,36 +302,27 @@ class ban(minqlx.Plugin):
         else:
             reason = ""
         
-        r = LENGTH_REGEX.match(" ".join(msg[2:4]).lower())
-        if r:
-            number = float(r.group("number"))
-            if number <= 0: return
-            scale = r.group("scale").rstrip("s")
-            td = None
-            
-            if scale == "second":
-                td = datetime.timedelta(seconds=number)
-            elif scale == "minute":
-                td = datetime.timedelta(minutes=number)
-            elif scale == "hour":
-                td = datetime.timedelta(hours=number)
-            elif scale == "day":
-                td = datetime.timedelta(days=number)
-            elif scale == "week":
-                td = datetime.timedelta(weeks=number)
-            elif scale == "month":
-                td = datetime.timedelta(days=number * 30)
-            elif scale == "year":
-                td = datetime.timedelta(weeks=number * 52)
-            
+        td = self.parse_length(" ".join(msg[2:4]))
+        if td:
             now = datetime.datetime.now().strftime(TIME_FORMAT)
             expires = (datetime.datetime.now() + td).strftime(TIME_FORMAT)
             base_key = PLAYER_KEY.format(ident) + ":bans"
-            ban_id = self.db.zcard(base_key)
+            # Expired bans get moved to the history, so count those too for a unique ID.
             db = self.db.pipeline()
-            db.zadd(base_key, time.time() + td.total_seconds(), ban_id)
+            db.zcard(base_key)
+            db.llen(base_key + ":history")
+            ban_id = sum(db.execute())
+            timestamp = time.time() + td.total_seconds()
+            db = self.db.pipeline()
+            db.zadd(base_key, timestamp, ban_id)
             ban = {"expires": expires, "reason": reason, "issued": now, "issued_by": player.steam_id}
             db.hmset(base_key + ":{}".format(ban_id), ban)
+            # Only the longest ban counts, so don't let a shorter one replace it.
+            current = self.bans.get(ident)
+            if not current or current[2] < timestamp:
+                self.bans[ident] = (datetime.datetime.strptime(expires, TIME_FORMAT), reason, timestamp)
+                db.zadd(BANS_KEY, timestamp, ident)
+            db.publish(BANS_CHANNEL, "{} {}".format(self.server_id, ident))
             db.execute()
             
             try:
@@ -240,9 +361,93 @@ class ban(minqlx.Plugin):
             db = self.db.pipeline()
             for ban_id, score in bans:
                 db.zincrby(base_key, ban_id, -score)
+            db.zrem(BANS_KEY, ident)
+            db.publish(BANS_CHANNEL, "{} {}".format(self.server_id, ident))
             db.execute()
+            self.bans.pop(ident, None)
             channel.reply("^6{}^7 has been unbanned.".format(name))
 
+    def cmd_banip(self, player, msg, channel):
+        """Bans an IP address or a whole network temporarily. Takes a client ID to ban
+        the address of a connected player.
+
+        Example #1: !banip 203.0.113.7 1 week Ban evasion
+
+        Example #2: !banip 203.0.113.0/24 30 days"""
+        if len(msg) < 4:
+            return minqlx.RET_USAGE
+
+        target_player = None
+        try:
+            ident = int(msg[1])
+            if 0 <= ident < 64:
+                target_player = self.player(ident)
+                network = ipaddress.ip_network(target_player.ip)
+            else:
+                channel.reply("Invalid client ID. Use either a client ID, an IP or a network.")
+                return
+        except ValueError:
+            try:
+                network = ipaddress.ip_network(msg[1], strict=False)
+            except ValueError:
+                channel.reply("Invalid IP. Use either a client ID, an IP or a network, like ^6203.0.113.0/24^7.")
+                return
+        except minqlx.NonexistentPlayerError:
+            channel.reply("Invalid client ID. Use either a client ID, an IP or a network.")
+            return
+
+        if target_player and self.db.has_permission(target_player.steam_id, 5):
+            channel.reply("^6{}^7 has permission level 5 and cannot be banned.".format(target_player.name))
+            return
+
+        if len(msg) > 4:
+            reason = " ".join(msg[4:])
+        else:
+            reason = ""
+
+        td = self.parse_length(" ".join(msg[2:4]))
+        if not td:
+            return
+
+        now = datetime.datetime.now().strftime(TIME_FORMAT)
+        expires = (datetime.datetime.now() + td).strftime(TIME_FORMAT)
+        timestamp = time.time() + td.total_seconds()
+        # A new ban on a network replaces the old one, so it can be shortened too.
+        db = self.db.pipeline()
+        db.zadd(IPBANS_KEY, timestamp, network.with_prefixlen)
+        ban = {"expires": expires, "reason": reason, "issued": now, "issued_by": player.steam_id}
+        db.hmset(IPBANS_KEY + ":" + network.with_prefixlen, ban)
+        db.publish(BANS_CHANNEL, "{} {}".format(self.server_id, network.with_prefixlen))
+        db.execute()
+
+        ban = (datetime.datetime.strptime(expires, TIME_FORMAT), reason, timestamp)
+        self.ip_bans.add(network, ban)
+        self.kick_banned_network(network, *ban[:2])
+        channel.reply("^6{} ^7has been banned. Ban expires on ^6{}^7.".format(network.with_prefixlen, expires))
+
+    def cmd_unbanip(self, player, msg, channel):
+        """Unbans an IP address or network banned with !banip."""
+        if len(msg) < 2:
+            return minqlx.RET_USAGE
+
+        try:
+            network = ipaddress.ip_network(msg[1], strict=False)
+        except ValueError:
+            channel.reply("Invalid IP. Use the IP or network exactly as it was banned.")
+            return
+
+        db = self.db.pipeline()
+        db.zrem(IPBANS_KEY, network.with_prefixlen)
+        db.delete(IPBANS_KEY + ":" + network.with_prefixlen)
+        db.publish(BANS_CHANNEL, "{} {}".format(self.server_id, network.with_prefixlen))
+        removed = db.execute()[0]
+        self.ip_bans.remove(network)
+
+        if removed:
+            channel.reply("^6{}^7 has been unbanned.".format(network.with_prefixlen))
+        else:
+            channel.reply("^7 No ban on ^6{}^7 found.".format(network.with_prefixlen))
+
     def cmd_checkban(self, player, msg, channel):
         """Checks whether a player has been banned, and if so, why."""
         if len(msg) < 2:
@@ -311,10 +516,10 @@ class ban(minqlx.Plugin):
             channel.reply("I do not know ^6{}^7.".format(name))
             return
         
-        try:
-            leaves = int(self.db[base_key + ":games_left"])
-        except KeyError:
-            leaves = 0
+        db = self.db.pipeline()
+        db.get(base_key + ":games_completed")
+        db.get(base_key + ":games_left")
+        completed, leaves = (int(n or 0) for n in db.execute())
         
         if leaves <= 0:
             channel.reply("^6{}^7's leaves are already at ^6{}^7.".format(name, leaves))
@@ -329,7 +534,17 @@ class ban(minqlx.Plugin):
                 channel.reply("Unintelligible number of leaves to forgive. Please use numbers.")
                 return
 
+        # Forgive the most recent leaves within the window as well.
+        if leaves_to_forgive > 0:
+            self.db.zremrangebyrank(base_key + ":leaves", -leaves_to_forgive, -1)
+
         new_leaves = leaves - leaves_to_forgive
+        self.leave_cache.pop(ident, None)
+        window = self.get_cvar("qlx_leaverBanWindow", float)
+        if window > 0:
+            self.rank_leavers([(ident,) + self.leave_counts(ident, window)])
+        else:
+            self.rank_leavers([(ident, completed, max(0, new_leaves))])
         if new_leaves <= 0:
             self.db[base_key + ":games_left"] = 0
             channel.reply("^6{}^7's leaves have been reduced to ^60^7.".format(name))
@@ -339,42 +554,535 @@ class ban(minqlx.Plugin):
                 .format(leaves_to_forgive, name, new_leaves))
 
 
+    def cmd_leavers(self, player, msg, channel):
+        """Lists the players that have left the largest share of their games."""
+        amount = 5
+        if len(msg) > 1:
+            try:
+                amount = min(20, max(1, int(msg[1])))
+            except ValueError:
+                return minqlx.RET_USAGE
+
+        leavers = self.db.zrevrange(LEAVERS_KEY, 0, amount - 1, withscores=True)
+        if not leavers or not leavers[0][1]:
+            channel.reply("^7Nobody has left enough games to be listed.")
+            return
+
+        # The names are the most recent ones essentials recorded.
+        db = self.db.pipeline()
+        for sid, ratio in leavers:
+            db.lindex(PLAYER_KEY.format(sid), 0)
+        names = db.execute()
+
+        channel.reply("^7Players that leave the most:")
+        for (sid, ratio), name in zip(leavers, names):
+            if not ratio:
+                break
+            channel.reply("  ^6{}^7: left ^6{}^7 percent of their games".format(name or sid, round(ratio * 100, 1)))
+
+    def cmd_compactbans(self, player, msg, channel):
+        """Archives expired and lifted bans and removes the keys they leave behind."""
+        channel.reply("^7Compacting bans...")
+        self.compact(channel)
+
+
+    def cmd_banexport(self, player, msg, channel):
+        """Writes every ban, including expired ones and their history, to a file in
+        fs_homepath/bans as JSON lines. Use !banimport to load them on another database."""
+        path = self.transfer_path(msg)
+        if not self.transfer_lock.acquire(blocking=False):
+            channel.reply("^7Bans are already being exported or imported.")
+            return
+
+        channel.reply("^7Exporting bans to ^6{}^7...".format(path))
+        self.export_bans(path, channel)
+
+    def cmd_banimport(self, player, msg, channel):
+        """Reads bans written by !banexport. Bans with the same ID as one already in the
+        database are skipped, so importing the same file twice does no harm."""
+        path = self.transfer_path(msg)
+        if not os.path.isfile(path):
+            channel.reply("^7There is no file at ^6{}^7.".format(path))
+            return
+        elif not self.transfer_lock.acquire(blocking=False):
+            channel.reply("^7Bans are already being exported or imported.")
+            return
+
+        channel.reply("^7Importing bans from ^6{}^7...".format(path))
+        self.import_bans(path, channel)
+
+
     # ====================================================================
     #                               HELPERS
     # ====================================================================
 
     def is_banned(self, steam_id):
-        base_key = PLAYER_KEY.format(steam_id) + ":bans"
-        bans = self.db.zrangebyscore(base_key, time.time(), "+inf", withscores=True)
-        if not bans:
+        """Get the expiration date and reason of a player's active ban, if any."""
+        if not self.bans_loaded:
+            ban = self.fetch_bans([steam_id]).get(steam_id)
+            return ban[:2] if ban else None
+
+        ban = self.bans.get(steam_id)
+        if not ban:
             return None
+        elif ban[2] <= time.time():
+            self.bans.pop(steam_id, None)
+            return None
+
+        return ban[:2]
+
+    def is_ip_banned(self, ip):
+        """Get the expiration date and reason of the ban on a network an IP belongs to, if any."""
+        if not ip:
+            return None
+
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+
+        now = time.time()
+        if not self.bans_loaded:
+            networks = self.db.zrangebyscore(IPBANS_KEY, now, "+inf")
+            for network, ban in self.fetch_ip_bans(networks).items():
+                if address in ipaddress.ip_network(network):
+                    return ban[:2]
+            return None
+
+        for network, ban in self.ip_bans.match(address):
+            if ban[2] > now:
+                return ban[:2]
+            self.ip_bans.remove(network)
+
+        return None
+
+    def parse_length(self, text):
+        """Turn something like "2 weeks" into a timedelta, or None if it can't."""
+        r = LENGTH_REGEX.match(text.lower())
+        if not r:
+            return None
+
+        number = float(r.group("number"))
+        if number <= 0:
+            return None
+        scale = r.group("scale").rstrip("s")
+
+        if scale == "second":
+            return datetime.timedelta(seconds=number)
+        elif scale == "minute":
+            return datetime.timedelta(minutes=number)
+        elif scale == "hour":
+            return datetime.timedelta(hours=number)
+        elif scale == "day":
+            return datetime.timedelta(days=number)
+        elif scale == "week":
+            return datetime.timedelta(weeks=number)
+        elif scale == "month":
+            return datetime.timedelta(days=number * 30)
+        elif scale == "year":
+            return datetime.timedelta(weeks=number * 52)
+
+    @minqlx.thread
+    def load_bans(self):
+        """Fill the ban indexes with every active ban in the database, trying again
+        every :data:`LOAD_RETRY` seconds until it works or the plugin is unloaded."""
+        while not self.ban_listener.stop_event.is_set():
+            try:
+                if not self.db.exists(BANS_INDEXED_KEY):
+                    self.build_ban_index()
 
-        longest_ban = self.db.hgetall(base_key + ":{}".format(bans[-1][0]))
-        expires = datetime.datetime.strptime(longest_ban["expires"], TIME_FORMAT)
+                self.db.zremrangebyscore(BANS_KEY, "-inf", time.time())
+                steam_ids = [int(steam_id) for steam_id in self.db.zrangebyscore(BANS_KEY, time.time(), "+inf")]
+                self.bans.update(self.fetch_bans(steam_ids))
+
+                networks = self.db.zrangebyscore(IPBANS_KEY, time.time(), "+inf")
+                for network, ban in self.fetch_ip_bans(networks).items():
+                    self.ip_bans.add(ipaddress.ip_network(network), ban)
+            except Exception:
+                minqlx.log_exception(self)
+                self.ban_listener.stop_event.wait(LOAD_RETRY)
+            else:
+                self.bans_loaded = True
+                return
+
+    def build_ban_index(self):
+        """Build the index of banned players from the bans of every player. Only needed
+        the first time it runs against a database with bans issued before there was an index."""
+        keys = list(self.db.scan_iter(match=PLAYER_KEY.format("*") + ":bans", count=1000))
+        db = self.db.pipeline()
+        for key in keys:
+            db.zrevrange(key, 0, 0, withscores=True)
+        now = time.time()
+        for key, longest in zip(keys, db.execute()):
+            if longest and longest[0][1] > now:
+                db.zadd(BANS_KEY, longest[0][1], key.split(":")[2])
+        db.set(BANS_INDEXED_KEY, 1)
+        db.execute()
+
+    def fetch_bans(self, steam_ids):
+        """Get the longest active ban of each player in two round trips."""
+        now = time.time()
+        db = self.db.pipeline()
+        for steam_id in steam_ids:
+            db.zrangebyscore(PLAYER_KEY.format(steam_id) + ":bans", now, "+inf", withscores=True)
+        latest = [(steam_id, bans[-1]) for steam_id, bans in zip(steam_ids, db.execute()) if bans]
+
+        for steam_id, (ban_id, score) in latest:
+            db.hgetall(PLAYER_KEY.format(steam_id) + ":bans:{}".format(ban_id))
+        res = {}
+        for (steam_id, (ban_id, score)), ban in zip(latest, db.execute()):
+            banned = self.active_ban(ban)
+            if banned:
+                res[steam_id] = banned + (score,)
+
+        return res
+
+    def fetch_ip_bans(self, networks):
+        """Get the bans on the given networks in a single round trip."""
+        now = time.time()
+        db = self.db.pipeline()
+        for network in networks:
+            db.zscore(IPBANS_KEY, network)
+            db.hgetall(IPBANS_KEY + ":" + network)
+        res = db.execute()
+
+        bans = {}
+        for network, score, ban in zip(networks, res[::2], res[1::2]):
+            if score is None or score <= now:
+                continue
+            banned = self.active_ban(ban)
+            if banned:
+                bans[network] = banned + (score,)
+
+        return bans
+
+    @minqlx.thread
+    def compact(self, channel=None, scheduled=False):
+        if scheduled:
+            interval = self.get_cvar("qlx_banCompactInterval", float)
+            if interval <= 0:
+                return
+            # Only one of the servers sharing the database needs to do it.
+            elif not self.db.set(COMPACT_LOCK_KEY, self.server_id, nx=True, ex=int(interval * 3600)):
+                return
+
+        try:
+            archived, reclaimed = self.compact_bans()
+        except Exception:
+            minqlx.log_exception(self)
+            if channel:
+                channel.reply("^7Compacting bans failed. Check the log for details.")
+            return
+
+        self.logger.info("Archived {} expired bans, reclaiming {} KB.".format(archived, reclaimed // 1024))
+        if channel:
+            channel.reply("^7Archived ^6{}^7 expired bans, reclaiming ^6{}^7 KB.".format(archived, reclaimed // 1024))
+
+    def compact_bans(self):
+        """Move every ban that has expired or been lifted into the history list next to its
+        ban set, as a line of JSON, and delete its hash. Goes through the ban sets in
+        batches, so it doesn't need all of them in memory at once.
+
+        Returns the number of bans archived and roughly how many bytes were freed.
+
+        """
+        before = self.db.info("memory")["used_memory"]
+        now = time.time()
+        archived = 0
+        batch = []
+        for key in self.db.scan_iter(match=PLAYER_KEY.format("*") + ":bans", count=COMPACT_BATCH):
+            batch.append(key)
+            if len(batch) >= COMPACT_BATCH:
+                archived += self.compact_batch(batch, now)
+                batch = []
+        batch.append(IPBANS_KEY)
+        archived += self.compact_batch(batch, now)
+        self.db.zremrangebyscore(BANS_KEY, "-inf", now)
+
+        after = self.db.info("memory")["used_memory"]
+        return archived, max(0, before - after)
+
+    def compact_batch(self, keys, now):
+        """Archive the expired bans in a batch of ban sets in three round trips."""
+        db = self.db.pipeline()
+        for key in keys:
+            db.zrangebyscore(key, "-inf", now, withscores=True)
+        expired = [(key, bans) for key, bans in zip(keys, db.execute()) if bans]
+        if not expired:
+            return 0
+
+        for key, bans in expired:
+            for ban_id, score in bans:
+                db.hgetall(key + ":" + ban_id)
+        details = iter(db.execute())
+
+        archived = 0
+        for key, bans in expired:
+            for ban_id, score in bans:
+                ban = next(details)
+                ban["id"] = ban_id
+                # Unbanning takes the score down to zero.
+                if score <= 0:
+                    ban["lifted"] = True
+                db.rpush(key + ":history", json.dumps(ban, separators=(",", ":")))
+                db.delete(key + ":" + ban_id)
+                db.zrem(key, ban_id)
+                archived += 1
+        db.execute()
+
+        return archived
+
+    def transfer_path(self, msg):
+        """Get the path of the file to export to or import from. Only file names are taken,
+        so that it can't be used to write anywhere else."""
+        name = os.path.basename(msg[1]) if len(msg) > 1 else ""
+        return os.path.join(self.get_cvar("fs_homepath"), TRANSFER_DIR, name or "bans.jsonl")
+
+    @minqlx.thread
+    def export_bans(self, path, channel):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            count = 0
+            with open(path, "w") as f:
+                batch = []
+                for key in self.db.scan_iter(match=PLAYER_KEY.format("*") + ":bans", count=TRANSFER_BATCH):
+                    batch.append(key)
+                    if len(batch) >= TRANSFER_BATCH:
+                        count += self.export_batch(f, batch)
+                        batch = []
+                batch.append(IPBANS_KEY)
+                count += self.export_batch(f, batch)
+        except Exception:
+            minqlx.log_exception(self)
+            channel.reply("^7Exporting bans failed. Check the log for details.")
+            return
+        finally:
+            self.transfer_lock.release()
+
+        channel.reply("^7Exported ^6{}^7 bans to ^6{}^7.".format(count, path))
+
+    def export_batch(self, f, keys):
+        """Write the bans in a batch of ban sets in two round trips. Each line is the ban's hash
+        plus its ID, its score and either the steam ID or network it's on. Archived bans are
+        written as they are in the history, plus the steam ID or network and "archived"."""
+        db = self.db.pipeline()
+        for key in keys:
+            db.zrange(key, 0, -1, withscores=True)
+            db.lrange(key + ":history", 0, -1)
+        res = db.execute()
+
+        for key, bans in zip(keys, res[::2]):
+            for ban_id, score in bans:
+                db.hgetall(key + ":" + ban_id)
+        details = iter(db.execute())
+
+        count = 0
+        for key, bans, history in zip(keys, res[::2], res[1::2]):
+            if key == IPBANS_KEY:
+                owner = {}
+            else:
+                owner = {"steam_id": key.split(":")[2]}
+            for ban_id, score in bans:
+                ban = next(details)
+                ban.update(owner, id=ban_id, score=score)
+                if not owner:
+                    ban["network"] = ban_id
+                f.write(json.dumps(ban, separators=(",", ":")) + "\n")
+                count += 1
+            for line in history:
+                ban = json.loads(line)
+                ban.update(owner, archived=True)
+                if not owner:
+                    ban["network"] = ban["id"]
+                f.write(json.dumps(ban, separators=(",", ":")) + "\n")
+                count += 1
+
+        return count
+
+    @minqlx.thread
+    def import_bans(self, path, channel):
+        try:
+            imported = 0
+            total = 0
+            # Histories being imported. They can be split across batches.
+            history = set()
+            with open(path) as f:
+                batch = []
+                for line in f:
+                    if line.strip():
+                        batch.append(json.loads(line))
+                    if len(batch) >= TRANSFER_BATCH:
+                        imported += self.import_batch(batch, history)
+                        total += len(batch)
+                        batch = []
+                imported += self.import_batch(batch, history)
+                total += len(batch)
+        except Exception:
+            minqlx.log_exception(self)
+            channel.reply("^7Importing bans failed. Check the log for details.")
+            return
+        finally:
+            self.transfer_lock.release()
+
+        channel.reply("^7Imported ^6{}^7 bans from ^6{}^7, skipping ^6{}^7 already there.".format(imported, path, total - imported))
+
+    def import_batch(self, bans, history):
+        """Write a batch of bans read from an export in two round trips, skipping bans that
+        are already in the database. The history of a player is only imported if they don't
+        have one yet. Active bans are added to the ban indexes and announced to the other servers.
+
+        Returns the number of bans imported.
+
+        """
+        # The ban set each ban goes in, and the key of its hash or history.
+        set_keys = []
+        keys = []
+        for ban in bans:
+            if "network" in ban:
+                set_key = IPBANS_KEY
+            else:
+                set_key = PLAYER_KEY.format(ban["steam_id"]) + ":bans"
+            set_keys.append(set_key)
+            keys.append(set_key + ":history" if ban.get("archived") else set_key + ":" + ban["id"])
+
+        db = self.db.pipeline()
+        for key in keys:
+            db.exists(key)
+        taken = db.execute()
+
+        now = time.time()
+        imported = 0
+        active = {}
+        for ban, set_key, key, exists in zip(bans, set_keys, keys, taken):
+            if exists and key not in history:
+                continue
+            imported += 1
+            if ban.pop("archived", None):
+                history.add(key)
+                ban.pop("steam_id", None)
+                ban.pop("network", None)
+                db.rpush(key, json.dumps(ban, separators=(",", ":")))
+                continue
+
+            owner = ban.pop("network", None) or int(ban.pop("steam_id"))
+            score = ban.pop("score")
+            db.zadd(set_key, score, ban.pop("id"))
+            db.hmset(key, ban)
+            if score > now:
+                active[owner] = max(score, active.get(owner, 0))
+        for owner, score in active.items():
+            if not isinstance(owner, str):
+                current = self.bans.get(owner)
+                db.zadd(BANS_KEY, max(score, current[2] if current else 0), owner)
+            db.publish(BANS_CHANNEL, "{} {}".format(self.server_id, owner))
+        db.execute()
+
+        # Pick them up here too.
+        for owner in active:
+            self.refresh_ban(str(owner))
+
+        return imported
+
+    @minqlx.next_frame
+    def kick_banned_network(self, network, expires, reason):
+        for p in self.players():
+            if not p.ip or self.db.has_permission(p.steam_id, 5):
+                continue
+            try:
+                if ipaddress.ip_address(p.ip) in network:
+                    self.kick(p.steam_id, "has been banned until ^6{}^7: {}".format(expires.strftime(TIME_FORMAT), reason))
+            except ValueError:
+                continue
+
+    @minqlx.next_frame
+    def kick_banned(self, steam_id, expires, reason):
+        try:
+            self.kick(steam_id, "has been banned until ^6{}^7: {}".format(expires.strftime(TIME_FORMAT), reason))
+        except ValueError:
+            pass
+
+    def active_ban(self, ban):
+        """Get the expiration date and reason of a ban hash if it hasn't expired yet."""
+        if not ban:
+            return None
+
+        expires = datetime.datetime.strptime(ban["expires"], TIME_FORMAT)
         if (expires - datetime.datetime.now()).total_seconds() > 0:
-            return expires, longest_ban["reason"]
+            return expires, ban["reason"]
         
         return None
 
+    def get_leaver_settings(self):
+        """Get the leaver ban cvars, only reading them again every now and then."""
+        if self.leaver_settings is None or time.time() - self.leaver_settings_time > CVAR_REFRESH:
+            self.leaver_settings = (self.get_cvar("qlx_leaverBan", bool),
+                self.get_cvar("qlx_leaverBanMinimumGames", int),
+                self.get_cvar("qlx_leaverBanWarnThreshold", float),
+                self.get_cvar("qlx_leaverBanThreshold", float),
+                self.get_cvar("qlx_leaverBanWindow", float))
+            self.leaver_settings_time = time.time()
+
+        return self.leaver_settings
+
     def leave_status(self, steam_id):
         """Get a player's status when it comes to leaving, given automatic leaver ban is on.
 
         """
-        if not self.get_cvar("qlx_leaverBan", bool):
+        settings = self.get_leaver_settings()
+        if not settings[0]:
             return None
 
-        try:
-            completed = self.db[PLAYER_KEY.format(steam_id) + ":games_completed"]
-            left = self.db[PLAYER_KEY.format(steam_id) + ":games_left"]
-        except KeyError:
+        window = settings[4]
+        cached = self.leave_cache.get(steam_id)
+        if cached and cached[1] == window and time.time() - cached[2] < LEAVE_CACHE_TTL:
+            counts = cached[0]
+        else:
+            counts = self.leave_counts(steam_id, window)
+            self.leave_cache[steam_id] = (counts, window, time.time())
+
+        if counts is None:
+            return None
+        return self.leave_action(*counts)
+
+    def leave_counts(self, steam_id, window):
+        """Get the games completed and left by a player, within the last window days if above 0."""
+        db = self.db.pipeline()
+        self.queue_leave_counts(db, steam_id, window)
+        completed, left = db.execute()
+        if completed is None or left is None:
             return None
-        
-        completed = int(completed)
-        left = int(left)
 
-        min_games_completed = self.get_cvar("qlx_leaverBanMinimumGames", int)
-        warn_threshold = self.get_cvar("qlx_leaverBanWarnThreshold", float)
-        ban_threshold = self.get_cvar("qlx_leaverBanThreshold", float)
+        return int(completed), int(left)
+
+    def queue_leave_counts(self, db, steam_id, window):
+        """Queue up the commands :meth:`leave_counts` reads the counts with on a pipeline."""
+        if window > 0:
+            # Only count the games within the window.
+            start = time.time() - window * 86400
+            db.zcount(PLAYER_KEY.format(steam_id) + ":games", start, "+inf")
+            db.zcount(PLAYER_KEY.format(steam_id) + ":leaves", start, "+inf")
+        else:
+            db.get(PLAYER_KEY.format(steam_id) + ":games_completed")
+            db.get(PLAYER_KEY.format(steam_id) + ":games_left")
+
+    def rank_leavers(self, players):
+        """Update the leaver ranking with (steam ID, games completed, games left) of players.
+        The counts are the ones within qlx_leaverBanWindow if it's set, like with bans."""
+        min_games = self.get_cvar("qlx_leaverBanMinimumGames", int)
+        db = self.db.pipeline()
+        for steam_id, completed, left in players:
+            completed, left = int(completed or 0), int(left or 0)
+            if completed + left >= max(1, min_games):
+                db.zadd(LEAVERS_KEY, left / (completed + left), steam_id)
+            else:
+                db.zrem(LEAVERS_KEY, steam_id)
+        db.execute()
+
+    def leave_action(self, completed, left):
+        """Decide what to do with a player given their games completed and left."""
+        enabled, min_games_completed, warn_threshold, ban_threshold, window = self.get_leaver_settings()
+        if not enabled:
+            return None
 
         # Check their games completed to total games ratio.
         total = completed + left
@@ -399,3 +1107,104 @@ class ban(minqlx.Plugin):
     def warn_player(self, player, ratio):
         player.tell("^7You have only completed ^6{}^7 percent of your games.".format(round(ratio * 100, 1)))
         player.tell("^7If you keep leaving you ^6will^7 be banned.")
+
+
+
+# ====================================================================
+#                            PREFIX INDEX
+# ====================================================================
+
+class PrefixIndex:
+    """A binary trie of IPv4 and IPv6 networks, so finding the networks an address
+    belongs to takes one step per bit of its prefix, no matter how many there are.
+
+    """
+    def __init__(self):
+        # Nodes are lists of [zero child, one child, network, item].
+        self.roots = {4: [None, None, None, None], 6: [None, None, None, None]}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _bits(self, network):
+        value = int(network.network_address)
+        width = network.max_prefixlen
+        for i in range(network.prefixlen):
+            yield (value >> (width - 1 - i)) & 1
+
+    def add(self, network, item):
+        node = self.roots[network.version]
+        for bit in self._bits(network):
+            if node[bit] is None:
+                node[bit] = [None, None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            self.size += 1
+        node[2] = network
+        node[3] = item
+
+    def remove(self, network):
+        node = self.roots[network.version]
+        for bit in self._bits(network):
+            node = node[bit]
+            if node is None:
+                return
+        if node[2] is not None:
+            self.size -= 1
+        node[2] = node[3] = None
+
+    def match(self, address):
+        """Get the (network, item) pairs of every network containing the address, widest first."""
+        node = self.roots[address.version]
+        value = int(address)
+        width = address.max_prefixlen
+        res = []
+        for i in range(width + 1):
+            if node[2] is not None:
+                res.append((node[2], node[3]))
+            if i == width:
+                break
+            node = node[(value >> (width - 1 - i)) & 1]
+            if node is None:
+                break
+
+        return res
+
+# ====================================================================
+#                            BAN LISTENER
+# ====================================================================
+
+class BanListener(threading.Thread):
+    """Listens on a channel for bans and unbans made by any server sharing the database,
+    handing each message to the handler. Reconnects on its own if the connection drops.
+
+    """
+    def __init__(self, db, channel, handler):
+        super().__init__(daemon=True)
+        self.db = db
+        self.channel = channel
+        self.handler = handler
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            pubsub = self.db.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                while not self.stop_event.is_set():
+                    message = pubsub.get_message(timeout=1)
+                    if not message:
+                        continue
+                    try:
+                        self.handler(message["data"])
+                    except Exception:
+                        minqlx.log_exception()
+            except Exception:
+                minqlx.log_exception()
+                self.stop_event.wait(LISTEN_RETRY)
+            finally:
+                pubsub.close()
+
+    def stop(self):
+        self.stop_event.set()
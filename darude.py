@@ -27,6 +27,11 @@ class darude(minqlx.Plugin):
             return
 
         self.last_sound = time.time()
+        essentials = self.plugins.get("essentials")
         for p in self.players():
-            #if self.db.get_flag(p, "essentials:sounds_enabled", default=True):
-            super().play_sound(self.sound_path, p)
+            if essentials:
+                enabled = essentials.sounds_enabled(p)
+            else:
+                enabled = self.db.get_flag(p, "essentials:sounds_enabled", default=True)
+            if enabled:
+                super().play_sound(self.sound_path, p)
@@ -22,6 +22,7 @@ import minqlx
 import minqlx.database
 import datetime
 import itertools
+import bisect
 import time
 import re
 import os
@@ -32,6 +33,44 @@ from collections import deque
 DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 TIME_FORMAT = "%H:%M:%S"
 
+# Sorted set of every name used by every player, as "<clean name in lowercase>:<steam ID>", all
+# with the same score so that they're ordered by name and can be searched by prefix.
+NAMES_KEY = "minqlx:names"
+# Most players a name search returns.
+NAME_SEARCH_LIMIT = 10
+# Number of players whose names are indexed per pipeline by !reindexnames.
+REINDEX_BATCH = 500
+# Seconds between checks of whether the map pool file has changed.
+MAPPOOL_CHECK = 5
+# Most maps suggested when a map vote doesn't match one in the map pool.
+MAP_SUGGESTION_LIMIT = 5
+
+# Records a connecting player's name and IP in a single round trip. The name is only added
+# if none of the last 20 is the same once colors are removed, like clean_text() does.
+# KEYS: names list, player set, IP set, the IP's players, the player's IPs, name index.
+# ARGV: name, clean name, steam ID, IP ("" if none), name index entry.
+UPDATE_PLAYER_SCRIPT = """
+redis.call("ZADD", KEYS[6], 0, ARGV[5])
+if ARGV[4] ~= "" then
+    redis.call("SADD", KEYS[3], ARGV[4])
+    redis.call("SADD", KEYS[4], ARGV[3])
+    redis.call("SADD", KEYS[5], ARGV[4])
+end
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    redis.call("LPUSH", KEYS[1], ARGV[1])
+    redis.call("SADD", KEYS[2], ARGV[3])
+    return 1
+end
+for _, name in ipairs(redis.call("LRANGE", KEYS[1], 0, -1)) do
+    if string.gsub(name, "%^%d", "") == ARGV[2] then
+        return 0
+    end
+end
+redis.call("LPUSH", KEYS[1], ARGV[1])
+redis.call("LTRIM", KEYS[1], 0, 19)
+return 1
+"""
+
 class essentials(minqlx.Plugin):
     database = minqlx.database.Redis
 
@@ -78,7 +117,9 @@ class essentials(minqlx.Plugin):
         self.add_command(("map", "changemap"), self.cmd_map, 2, usage="<mapname> [factory]")
         self.add_command(("help", "about", "version"), self.cmd_help)
         self.add_command("db", self.cmd_db, 5, usage="<key> [value]")
-        self.add_command("seen", self.cmd_seen, usage="<steam_id>")
+        self.add_command("seen", self.cmd_seen, usage="<steam_id|name>")
+        self.add_command("alts", self.cmd_alts, 2, usage="<id|ip>")
+        self.add_command("reindexnames", self.cmd_reindexnames, 5)
         self.add_command("time", self.cmd_time, usage="[timezone_offset]")
         self.add_command(("teamsize", "ts"), self.cmd_teamsize, 2, usage="<size>")
         self.add_command("rcon", self.cmd_rcon, 5)
@@ -99,23 +140,25 @@ class essentials(minqlx.Plugin):
         self.recent_cmds = deque(maxlen=11)
         # A short history of recently disconnected players.
         self.recent_dcs = deque(maxlen=10)
+        # The sounds flag of connected players, by steam ID. See sounds_enabled().
+        self.sound_flags = {}
+
+        self.update_player_script = self.db.register_script(UPDATE_PLAYER_SCRIPT)
         
-        # Map voting stuff. fs_homepath takes precedence.
+        # Map voting stuff. The file is read again if it changes. See get_mappool().
         self.mappool = None
-        mphome = os.path.join(self.get_cvar("fs_homepath", str),
-            "baseq3", self.get_cvar("sv_mappoolfile"))
-        if os.path.isfile(mphome):
-            self.mappool = self.parse_mappool(mphome)
-        else:
-            mpbase = os.path.join(self.get_cvar("fs_basepath", str),
-                "baseq3", self.get_cvar("sv_mappoolfile"))
-            if os.path.isfile(mpbase):
-                self.mappool = self.parse_mappool(mpbase)
+        self.mappool_names = []
+        self.mappool_path = None
+        self.mappool_mtime = None
+        self.mappool_checked = 0
+        self.get_mappool()
 
     def handle_player_connect(self, player):
         self.update_player(player)
+        self.cache_sound_flag(player)
 
     def handle_player_disconnect(self, player, reason):
+        self.sound_flags.pop(player.steam_id, None)
         self.recent_dcs.appendleft((player, time.time()))
         self.update_seen_player(player)
 
@@ -135,7 +178,7 @@ class essentials(minqlx.Plugin):
                 return minqlx.RET_STOP_ALL
         
         # Enforce map pool.
-        if vote.lower() == "map" and self.mappool and self.get_cvar("qlx_enforceMappool", bool):
+        if vote.lower() == "map" and self.get_mappool() and self.get_cvar("qlx_enforceMappool", bool):
             split_args = args.split()
             if len(split_args) == 0:
                 caller.tell("Available maps and factories:")
@@ -150,8 +193,15 @@ class essentials(minqlx.Plugin):
                         .format(self.get_cvar("qlx_commandPrefix")))
                     return minqlx.RET_STOP_ALL
             else:
-                caller.tell("This map is not allowed. Use {}mappool to see available options."
-                    .format(self.get_cvar("qlx_commandPrefix")))
+                matches = self.match_maps(map_name)
+                if len(matches) > MAP_SUGGESTION_LIMIT:
+                    caller.tell("Did you mean ^6{}^7, or one of ^6{}^7 more?".format(
+                        "^7, ^6".join(matches[:MAP_SUGGESTION_LIMIT]), len(matches) - MAP_SUGGESTION_LIMIT))
+                elif matches:
+                    caller.tell("Did you mean ^6{}^7?".format("^7 or ^6".join(matches)))
+                else:
+                    caller.tell("This map is not allowed. Use {}mappool to see available options."
+                        .format(self.get_cvar("qlx_commandPrefix")))
                 return minqlx.RET_STOP_ALL
         
         # Automatic vote passing.
@@ -184,7 +234,7 @@ class essentials(minqlx.Plugin):
             player.tell(out[:-1])
         
         player_list = self.players()
-        if not player_list:
+        if not player_list and len(msg) == 1:
             player.tell("There are no players connected at the moment.")
         elif len(msg) == 1:
             player.tell("All connected players:")
@@ -199,7 +249,15 @@ class essentials(minqlx.Plugin):
                 player.tell("A total of ^6{}^7 players matched:".format(len(players)))
                 list_alternatives(players)
             else:
-                player.tell("Sorry, but no players matched your tokens.")
+                # Look for players that aren't here, by the start of any name they've used.
+                seen = {}
+                for name in msg[1:]:
+                    seen.update(self.search_names(name))
+                if seen:
+                    player.tell("No connected players matched, but these have been seen before:")
+                    player.tell("\n".join("  {}^6:^7 {}".format(sid, name) for sid, name in seen.items()))
+                else:
+                    player.tell("Sorry, but no players matched your tokens.")
 
         # We reply directly to the player, so no need to let the event pass.
         return minqlx.RET_STOP_ALL
@@ -295,8 +353,9 @@ class essentials(minqlx.Plugin):
         return minqlx.RET_STOP_ALL
 
     def cmd_enable_sounds(self, player, msg, channel):
-        flag = self.db.get_flag(player, "essentials:sounds_enabled", default=True)
+        flag = self.sounds_enabled(player)
         self.db.set_flag(player, "essentials:sounds_enabled", not flag)
+        self.sound_flags[player.steam_id] = not flag
         
         if flag:
             player.tell("Sounds have been disabled. Use ^6{}sounds^7 to enable them again."
@@ -312,7 +371,7 @@ class essentials(minqlx.Plugin):
         if len(msg) < 2:
             return minqlx.RET_USAGE
 
-        if not self.db.get_flag(player, "essentials:sounds_enabled", default=True):
+        if not self.sounds_enabled(player):
             player.tell("Sounds are disabled. Use ^6{}sounds^7 to enable them again."
                 .format(self.get_cvar("qlx_commandPrefix")))
             return minqlx.RET_STOP_ALL
@@ -326,7 +385,7 @@ class essentials(minqlx.Plugin):
         players = self.players()
         players.remove(player)
         for p in players:
-            if self.db.get_flag(p, "essentials:sounds_enabled", default=True):
+            if self.sounds_enabled(p):
                 self.play_sound(msg[1], p)
 
         return minqlx.RET_STOP_ALL
@@ -336,7 +395,7 @@ class essentials(minqlx.Plugin):
         if len(msg) < 2:
             return minqlx.RET_USAGE
 
-        if not self.db.get_flag(player, "essentials:sounds_enabled", default=True):
+        if not self.sounds_enabled(player):
             player.tell("Sounds are disabled. Use ^6{}sounds^7 to enable them again."
                 .format(self.get_cvar("qlx_commandPrefix")))
             return minqlx.RET_STOP_ALL
@@ -350,14 +409,14 @@ class essentials(minqlx.Plugin):
         players = self.players()
         players.remove(player)
         for p in players:
-            if self.db.get_flag(p, "essentials:sounds_enabled", default=True):
+            if self.sounds_enabled(p):
                 self.play_music(msg[1], p)
 
         return minqlx.RET_STOP_ALL
 
     def cmd_stopsound(self, player, msg, channel):
         """Stops all sounds playing. Useful if someone plays one of those really long ones."""
-        if not self.db.get_flag(player, "essentials:sounds_enabled", default=True):
+        if not self.sounds_enabled(player):
             player.tell("Sounds are disabled. Use ^6{}sounds^7 to enable them again."
                 .format(self.get_cvar("qlx_commandPrefix")))
             return minqlx.RET_STOP_ALL
@@ -366,7 +425,7 @@ class essentials(minqlx.Plugin):
 
     def cmd_stopmusic(self, player, msg, channel):
         """Stops any music playing."""
-        if not self.db.get_flag(player, "essentials:sounds_enabled", default=True):
+        if not self.sounds_enabled(player):
             player.tell("Sounds are disabled. Use ^6{}sounds^7 to enable them again."
                 .format(self.get_cvar("qlx_commandPrefix")))
             return minqlx.RET_STOP_ALL
@@ -662,8 +721,18 @@ class essentials(minqlx.Plugin):
         if len(msg) < 2:
             return minqlx.RET_USAGE
         
+        # Allow partial names of maps in the map pool.
+        map_name = msg[1]
+        if self.get_mappool() and map_name.lower() not in self.mappool:
+            matches = self.match_maps(map_name.lower())
+            if len(matches) == 1:
+                map_name = matches[0]
+            elif matches:
+                channel.reply("^7That could be any of these: ^6{}^7.".format("^7, ^6".join(matches)))
+                return
+
         # TODO: Give feedback on !map.
-        self.change_map(msg[1], msg[2] if len(msg) > 2 else None)
+        self.change_map(map_name, msg[2] if len(msg) > 2 else None)
         
     def cmd_help(self, player, msg, channel):
         # TODO: Perhaps print some essential commands in !help
@@ -701,16 +770,23 @@ class essentials(minqlx.Plugin):
         """Responds with the last time a player was seen on the server."""
         if len(msg) < 2:
             return minqlx.RET_USAGE
-        # TODO: Save a couple of nicknames in DB and have !seen work with nicks too?
 
+        name = None
         try:
             steam_id = int(msg[1])
             if steam_id < 64:
                 channel.reply("Invalid SteamID64.")
                 return
         except ValueError:
-            channel.reply("Unintelligible SteamID64.")
-            return
+            matches = self.search_names(" ".join(msg[1:]))
+            if not matches:
+                channel.reply("^7I don't know anyone whose name starts with that.")
+                return
+            elif len(matches) > 1:
+                channel.reply("^7That could be any of these: {}. Use their SteamID64 instead."
+                    .format(", ".join("^6{}^7 ({})".format(name, sid) for sid, name in matches.items())))
+                return
+            steam_id, name = matches.popitem()
         
         p = self.player(steam_id)
         if p:
@@ -718,7 +794,10 @@ class essentials(minqlx.Plugin):
             return
         
         key = "minqlx:players:{}:last_seen".format(steam_id)
-        name = "that player" if steam_id != minqlx.owner() else "my ^6master^7"
+        if steam_id == minqlx.owner():
+            name = "my ^6master^7"
+        elif not name:
+            name = "that player"
         if key in self.db:
             then = datetime.datetime.strptime(self.db[key], DATETIME_FORMAT)
             td = datetime.datetime.now() - then
@@ -732,6 +811,46 @@ class essentials(minqlx.Plugin):
         else:
             channel.reply("^7I have never seen {} before.".format(name))
 
+    def cmd_alts(self, player, msg, channel):
+        """Lists the accounts that have connected from the same IPs as a player, or from an IP."""
+        if len(msg) < 2:
+            return minqlx.RET_USAGE
+
+        try:
+            ident = int(msg[1])
+            if 0 <= ident < 64:
+                ident = self.player(ident).steam_id
+            ips = self.db.smembers("minqlx:players:{}:ips".format(ident))
+            if not ips:
+                channel.reply("^7I don't know of any IPs ^6{}^7 has used.".format(ident))
+                return
+            steam_ids = self.db.sunion(["minqlx:ips:" + ip for ip in ips])
+            steam_ids.discard(str(ident))
+        except ValueError:
+            steam_ids = self.db.smembers("minqlx:ips:" + msg[1])
+        except (minqlx.NonexistentPlayerError, AttributeError):
+            channel.reply("Invalid client ID. Use either a client ID, a SteamID64 or an IP.")
+            return
+
+        if not steam_ids:
+            channel.reply("^7No other accounts found.")
+            return
+
+        # Show the most recent name of each.
+        steam_ids = sorted(steam_ids)
+        db = self.db.pipeline()
+        for sid in steam_ids:
+            db.lindex("minqlx:players:" + sid, 0)
+        names = db.execute()
+        channel.reply("^7Found ^6{}^7 accounts: {}".format(len(steam_ids),
+            ", ".join("{}^7 ({})".format(name or "?", sid) for sid, name in zip(steam_ids, names))))
+
+    def cmd_reindexnames(self, player, msg, channel):
+        """Adds the names of every known player to the name index used by !id and !seen.
+        Only needed once for players that haven't connected since the index was added."""
+        channel.reply("^7Indexing names...")
+        self.reindex_names(channel)
+
     def cmd_time(self, player, msg, channel):
         """Responds with the current time."""
         tz_offset = time.timezone if (time.localtime().tm_isdst == 0) else time.altzone
@@ -778,7 +897,7 @@ class essentials(minqlx.Plugin):
             minqlx.console_command(" ".join(msg[1:]))
 
     def cmd_mappool(self, player, msg, channel):
-        if not self.mappool or not self.get_cvar("qlx_enforceMappool", bool):
+        if not self.get_mappool() or not self.get_cvar("qlx_enforceMappool", bool):
             player.tell("No map pool is being enforced. You are free to vote any map.")
         else:
             self.tell_mappool(player)
@@ -795,26 +914,85 @@ class essentials(minqlx.Plugin):
         and adds entries to the player list and IP entries.
 
         """
-        base_key = "minqlx:players:" + str(player.steam_id)
+        self.write_player(player.steam_id, player.name, player.clean_name, player.ip)
+
+    @minqlx.thread
+    def write_player(self, steam_id, name, clean_name, ip):
+        base_key = "minqlx:players:" + str(steam_id)
+        ip = ip or ""
+        self.update_player_script(
+            keys=[base_key, "minqlx:players", "minqlx:ips", "minqlx:ips:" + ip, base_key + ":ips", NAMES_KEY],
+            args=[name, clean_name, steam_id, ip, self.name_entry(clean_name, steam_id)])
+
+    def name_entry(self, clean_name, steam_id):
+        return "{}:{}".format(clean_name.lower(), steam_id)
+
+    def search_names(self, prefix):
+        """Find players that have used a name starting with the prefix, colors and case aside.
+        Returns a dict of steam IDs to the matching name, in lowercase."""
+        prefix = self.clean_text(prefix).lower()
+        if not prefix:
+            return {}
+
+        # Players usually have a few names in there, so get enough to fill the limit.
+        entries = self.db.zrangebylex(NAMES_KEY, "[" + prefix, "[" + prefix + "\U0010ffff",
+            start=0, num=NAME_SEARCH_LIMIT * 5)
+        res = {}
+        for entry in entries:
+            name, steam_id = entry.rsplit(":", 1)
+            res.setdefault(int(steam_id), name)
+            if len(res) >= NAME_SEARCH_LIMIT:
+                break
+
+        return res
+
+    @minqlx.thread
+    def reindex_names(self, channel):
+        count = 0
+        batch = []
+        for steam_id in self.db.sscan_iter("minqlx:players", count=REINDEX_BATCH):
+            batch.append(steam_id)
+            if len(batch) >= REINDEX_BATCH:
+                count += self.index_names(batch)
+                batch = []
+        count += self.index_names(batch)
+        channel.reply("^7Indexed ^6{}^7 names.".format(count))
+
+    def index_names(self, steam_ids):
         db = self.db.pipeline()
-        
-        # Add to IP set and make IP entry.
-        if player.ip:
-            db.sadd("minqlx:ips", player.ip)
-            db.sadd("minqlx:ips:" + player.ip, player.steam_id)
-            db.sadd(base_key + ":ips", player.ip)
-        
-        # Make or update player entry.
-        if base_key not in self.db:
-            db.lpush(base_key, player.name)
-            db.sadd("minqlx:players", player.steam_id)
-        else:
-            names = [self.clean_text(n) for n in self.db.lrange(base_key, 0, -1)]
-            if player.clean_name not in names:
-                db.lpush(base_key, player.name)
-                db.ltrim(base_key, 0, 19)
-        
+        for steam_id in steam_ids:
+            db.lrange("minqlx:players:" + steam_id, 0, -1)
+        count = 0
+        for steam_id, names in zip(steam_ids, db.execute()):
+            for name in names:
+                db.zadd(NAMES_KEY, 0, self.name_entry(self.clean_text(name), steam_id))
+                count += 1
         db.execute()
+        return count
+
+    @minqlx.thread
+    def cache_sound_flag(self, player):
+        flag = self.db.get_flag(player, "essentials:sounds_enabled", default=True)
+        self.store_sound_flag(player.steam_id, flag)
+
+    @minqlx.next_frame
+    def store_sound_flag(self, steam_id, flag):
+        # They might have left or used !sounds while we were reading it.
+        if self.player(steam_id):
+            self.sound_flags.setdefault(steam_id, flag)
+
+    def sounds_enabled(self, player):
+        """Whether or not a player has sounds enabled with !sounds. The flags of connected
+        players are kept in memory, so other plugins playing sounds to everyone should use
+        this through ``self.plugins["essentials"]`` rather than the database.
+
+        """
+        try:
+            return self.sound_flags[player.steam_id]
+        except KeyError:
+            flag = self.db.get_flag(player, "essentials:sounds_enabled", default=True)
+            self.sound_flags[player.steam_id] = flag
+            return flag
 
     def update_seen_player(self, player):
         key = "minqlx:players:" + str(player.steam_id) + ":last_seen"
@@ -835,11 +1013,49 @@ class essentials(minqlx.Plugin):
                     return
             minqlx.force_vote(True)
     
+    def get_mappool(self):
+        """Get the map pool, reading the file again if it has changed since last time.
+        fs_homepath takes precedence over fs_basepath.
+
+        """
+        now = time.time()
+        if now - self.mappool_checked < MAPPOOL_CHECK:
+            return self.mappool
+        self.mappool_checked = now
+
+        try:
+            if not self.mappool_path:
+                raise OSError
+            mtime = os.path.getmtime(self.mappool_path)
+        except OSError:
+            # Not found yet or removed since, so look for it again.
+            self.mappool_path = None
+            mtime = None
+            for cvar in ("fs_homepath", "fs_basepath"):
+                path = os.path.join(self.get_cvar(cvar, str), "baseq3", self.get_cvar("sv_mappoolfile"))
+                if os.path.isfile(path):
+                    self.mappool_path = path
+                    mtime = os.path.getmtime(path)
+                    break
+
+        if mtime != self.mappool_mtime:
+            self.mappool_mtime = mtime
+            self.mappool = self.parse_mappool(self.mappool_path) if self.mappool_path else None
+            self.mappool_names = sorted(self.mappool) if self.mappool else []
+
+        return self.mappool
+
+    def match_maps(self, prefix):
+        """Get the maps in the map pool that start with the prefix."""
+        start = bisect.bisect_left(self.mappool_names, prefix)
+        end = bisect.bisect_left(self.mappool_names, prefix + "\U0010ffff", start)
+        return self.mappool_names[start:end]
+
     def parse_mappool(self, path):
         """Read and parse the map pool file into a dictionary.
     
         Structure as follows:
-        {'campgrounds': ['ca', 'ffa'], 'overkill': ['ca']}
+        {'campgrounds': {'ca', 'ffa'}, 'overkill': {'ca'}}
         
         """
         mappool = {}
@@ -858,16 +1074,13 @@ class essentials(minqlx.Plugin):
                 # Maps are case-insensitive, but not factories.
                 key = key.lower()
 
-                if key in mappool:
-                    mappool[key].append(value.strip())
-                else:
-                    mappool[key] = [value.strip()]
+                mappool.setdefault(key, set()).add(value.strip())
         
         return mappool
 
     def tell_mappool(self, player, indent=0):
         out = ""
-        for m in self.mappool:
+        for m in self.mappool_names:
             out += ("{0}Map: {1:25} Factories: {2}\n"
-                .format(" " * indent, m, ", ".join(val for val in self.mappool[m])))
+                .format(" " * indent, m, ", ".join(sorted(self.mappool[m]))))
         player.tell(out.rstrip("\n"))
@@ -0,0 +1,251 @@
+"""Offline benchmark and simulation harness for the balancing done by the balance plugin.
+
+It replaces minqlx with a small stand-in that has just enough of the player and team
+API for the balance plugin to run, fills lobbies with synthetic players, runs the
+whole !balance path on them and reports how long each call took, how many moves it
+made and how far apart the team averages ended up. The old greedy switch loop is
+run on the same lobbies for comparison.
+
+Run it from the root of the repository, outside of the server:
+
+    python3 extras/balance_bench.py --rounds 200 --sizes 2,4,8,16
+
+Add --uneven 1 to start every lobby with one player too many on red, like 9v7.
+
+"""
+
+import argparse
+import itertools
+import os.path
+import random
+import statistics
+import sys
+import time
+import types
+
+RATING_MEAN = 1500
+RATING_DEVIATION = 300
+RATING_MIN = 500
+RATING_MAX = 3000
+
+# ====================================================================
+#                           MINQLX STAND-IN
+# ====================================================================
+
+class FakePlayer:
+    def __init__(self, lobby, steam_id, team):
+        self.lobby = lobby
+        self.steam_id = steam_id
+        self.name = self.clean_name = "player{}".format(steam_id)
+        self.team = team
+
+    def __repr__(self):
+        return self.name
+
+    def put(self, team):
+        self.lobby.puts += 1
+        self.team = team
+
+    def update(self):
+        pass
+
+    def tell(self, msg):
+        pass
+
+class FakeChannel:
+    def __init__(self):
+        self.replies = []
+
+    def reply(self, msg):
+        self.replies.append(msg)
+
+class FakeGame:
+    type_short = "ca"
+    state = "warmup"
+
+class Lobby:
+    """A server with players on it, keeping count of the moves made."""
+    def __init__(self, ratings, rng, uneven=0):
+        self.players = []
+        self.ratings = ratings
+        for i, rating in enumerate(ratings):
+            # The first *uneven* blue players start out on red instead.
+            team = "red" if i % 2 or i < 2 * uneven else "blue"
+            self.players.append(FakePlayer(self, 76561198000000000 + i, team))
+        # Start out with the teams in a random order, like after a shuffle.
+        teams = [p.team for p in self.players]
+        rng.shuffle(teams)
+        for p, team in zip(self.players, teams):
+            p.team = team
+        self.switches = 0
+        self.puts = 0
+
+    @property
+    def moves(self):
+        return 2 * self.switches + self.puts
+
+    def teams(self):
+        res = {"free": [], "red": [], "blue": [], "spectator": []}
+        for p in self.players:
+            res[p.team].append(p)
+        return res
+
+    def switch(self, p1, p2):
+        self.switches += 1
+        p1.team, p2.team = p2.team, p1.team
+
+    def averages(self):
+        teams = self.teams()
+        rating = dict((p.steam_id, r) for p, r in zip(self.players, self.ratings))
+        red = [rating[p.steam_id] for p in teams["red"]]
+        blue = [rating[p.steam_id] for p in teams["blue"]]
+        return statistics.mean(red), statistics.mean(blue)
+
+class FakePlugin:
+    lobby = None
+    cvars = {}
+
+    def __init__(self):
+        pass
+
+    def add_hook(self, *args, **kwargs):
+        pass
+
+    def add_command(self, *args, **kwargs):
+        pass
+
+    def set_cvar_once(self, name, value):
+        self.cvars.setdefault(name, value)
+
+    def get_cvar(self, name, return_type=str):
+        value = self.cvars.get(name)
+        if return_type == bool:
+            return bool(int(value))
+        return return_type(value)
+
+    @property
+    def game(self):
+        return FakeGame()
+
+    def teams(self):
+        return self.lobby.teams()
+
+    def players(self):
+        return list(self.lobby.players)
+
+    def switch(self, p1, p2):
+        self.lobby.switch(p1, p2)
+
+    def msg(self, msg):
+        pass
+
+class NonexistentPlayerError(Exception):
+    pass
+
+def install_stub():
+    """Put a minqlx stand-in in sys.modules. Delayed and threaded functions
+    are run right away, which is what we want for timing."""
+    minqlx = types.ModuleType("minqlx")
+    minqlx.Plugin = FakePlugin
+    minqlx.thread = minqlx.next_frame = lambda func: func
+    minqlx.delay = lambda seconds: (lambda func: func)
+    minqlx.log_exception = lambda *args: None
+    minqlx.NonexistentPlayerError = NonexistentPlayerError
+    minqlx.CHAT_CHANNEL = FakeChannel()
+    minqlx.RET_NONE, minqlx.RET_STOP, minqlx.RET_STOP_EVENT, minqlx.RET_STOP_ALL, minqlx.RET_USAGE = range(5)
+    minqlx.PRI_HIGHEST, minqlx.PRI_HIGH, minqlx.PRI_NORMAL, minqlx.PRI_LOW, minqlx.PRI_LOWEST = range(5)
+
+    database = types.ModuleType("minqlx.database")
+    database.Redis = object
+    minqlx.database = database
+
+    sys.modules["minqlx"] = minqlx
+    sys.modules["minqlx.database"] = database
+
+def load_balance():
+    install_stub()
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    import balance
+    plugin = balance.balance()
+    # We never hit the rating service, so there's no need for the fetcher.
+    plugin.fetcher.stop()
+    return plugin
+
+# ====================================================================
+#                             SIMULATION
+# ====================================================================
+
+def random_ratings(rng, n):
+    return [int(min(RATING_MAX, max(RATING_MIN, rng.gauss(RATING_MEAN, RATING_DEVIATION)))) for _ in range(n)]
+
+def legacy_balance(lobby):
+    """The greedy loop the plugin used before the partition engine, kept as a baseline."""
+    rating = dict((p.steam_id, r) for p, r in zip(lobby.players, lobby.ratings))
+    def average(team):
+        return sum(rating[p.steam_id] for p in team) / len(team)
+
+    teams = lobby.teams()
+    while True:
+        cur_diff = abs(average(teams["red"]) - average(teams["blue"]))
+        min_diff = cur_diff
+        best_pair = None
+        for red_p, blue_p in itertools.product(teams["red"], teams["blue"]):
+            r = [p for p in teams["red"] if p is not red_p] + [blue_p]
+            b = [p for p in teams["blue"] if p is not blue_p] + [red_p]
+            diff = abs(average(r) - average(b))
+            if diff < min_diff:
+                min_diff = diff
+                best_pair = (red_p, blue_p)
+        if not best_pair:
+            break
+        lobby.switch(*best_pair)
+        teams = lobby.teams()
+
+def run_plugin(plugin, lobby):
+    plugin.lobby = lobby
+    for p, rating in zip(lobby.players, lobby.ratings):
+        plugin.ratings.set(p.steam_id, "ca", rating, 100, time.time())
+    plugin.cmd_balance(lobby.players[0], ["!balance"], FakeChannel())
+
+def simulate(name, run, size, rounds, seed, plugin=None, uneven=0):
+    rng = random.Random(seed)
+    timings, moves, diffs = [], [], []
+    for _ in range(rounds):
+        lobby = Lobby(random_ratings(rng, 2 * size), rng, uneven)
+        start = time.perf_counter()
+        if plugin:
+            run(plugin, lobby)
+        else:
+            run(lobby)
+        timings.append((time.perf_counter() - start) * 1000)
+        moves.append(lobby.moves)
+        red, blue = lobby.averages()
+        diffs.append(abs(red - blue))
+
+    print("{:>10} {:>5}v{:<3} {:>10.3f} {:>10.3f} {:>8.2f} {:>10.2f} {:>10.2f}".format(
+        name, size + uneven, size - uneven, statistics.mean(timings), max(timings),
+        statistics.mean(moves), statistics.mean(diffs), max(diffs)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the balance plugin offline.")
+    parser.add_argument("--rounds", type=int, default=100, help="lobbies to simulate per team size")
+    parser.add_argument("--sizes", default="2,4,6,8,12,16", help="comma-separated team sizes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-baseline", action="store_true", help="skip the old greedy loop")
+    parser.add_argument("--uneven", type=int, default=0,
+        help="players to start out on red instead of blue, like 9v7 with 1 on 8v8")
+    args = parser.parse_args()
+
+    plugin = load_balance()
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    print("{:>10} {:>9} {:>10} {:>10} {:>8} {:>10} {:>10}".format(
+        "algorithm", "lobby", "avg ms", "max ms", "moves", "avg diff", "max diff"))
+    for size in sizes:
+        simulate("plugin", run_plugin, size, args.rounds, args.seed, plugin, args.uneven)
+        if not args.no_baseline and not args.uneven:
+            # The greedy loop only ever switches pairs, so it can't even out the teams.
+            simulate("greedy", legacy_balance, size, args.rounds, args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -168,8 +168,13 @@ class fun(minqlx.Plugin):
             return
 
         self.last_sound = time.time()
+        essentials = self.plugins.get("essentials")
         for p in self.players():
-            if self.db.get_flag(p, "essentials:sounds_enabled", default=True):
+            if essentials:
+                enabled = essentials.sounds_enabled(p)
+            else:
+                enabled = self.db.get_flag(p, "essentials:sounds_enabled", default=True)
+            if enabled:
                 super().play_sound(path, p)
 
     def cmd_cookies(self, player, msg, channel):
@@ -62,8 +62,14 @@ class motd(minqlx.Plugin):
         if welcome_sound == "0":
             welcome_sound = ""
         
-        if welcome_sound and self.db.get_flag(player, "essentials:sounds_enabled", default=True):
-            self.play_sound(welcome_sound, player)
+        if welcome_sound:
+            essentials = self.plugins.get("essentials")
+            if essentials:
+                enabled = essentials.sounds_enabled(player)
+            else:
+                enabled = self.db.get_flag(player, "essentials:sounds_enabled", default=True)
+            if enabled:
+                self.play_sound(welcome_sound, player)
         self.send_motd(player, motd)
 
     def cmd_setmotd(self, player, msg, channel):
@@ -18,12 +18,24 @@
 
 import minqlx
 import datetime
+import threading
+import array
+import heapq
 import time
+import uuid
 import re
 
 LENGTH_REGEX = re.compile(r"(?P<number>[0-9]+) (?P<scale>seconds?|minutes?|hours?|days?|weeks?|months?|years?)")
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 PLAYER_KEY = "minqlx:players:{}"
+# Longest the expiry timer sleeps before checking again, in seconds.
+MAX_TIMER = 3600
+# Channel every server publishes to when it silences or unsilences someone.
+SILENCES_CHANNEL = "minqlx:silences:updates"
+# Seconds to wait before listening again after losing the connection.
+LISTEN_RETRY = 5
+# Seconds before the flood cvars are read again.
+CVAR_REFRESH = 10
 
 class silence(minqlx.Plugin):
     def __init__(self):
@@ -31,34 +43,95 @@ class silence(minqlx.Plugin):
         self.add_hook("player_loaded", self.handle_player_loaded)
         self.add_hook("player_disconnect", self.handle_player_disconnect)
         self.add_hook("client_command", self.handle_client_command, priority=minqlx.PRI_HIGH)
+        self.add_hook("unload", self.handle_unload)
         self.add_command("silence", self.cmd_silence, 2, usage="<id> <length> seconds|minutes|hours|days|... [reason]")
         self.add_command("unsilence", self.cmd_unsilence, 2, usage="<id>")
         self.add_command("checksilence", self.cmd_checksilence, usage="<id>")
+        self.add_command("floodstats", self.cmd_floodstats, 2)
 
+        # Cvars.
+        self.set_cvar_once("qlx_silenceFlood", "0")
+        self.set_cvar_once("qlx_silenceFloodRate", "1")
+        self.set_cvar_once("qlx_silenceFloodBurst", "5")
+        self.set_cvar_once("qlx_silenceFloodLength", "60")
+
+        # Silenced players on the server, by steam ID, as (expires, score, reason).
         self.silenced = {}
+        # Heap of (score, steam ID) of the above, so they can be unmuted when it ends.
+        self.expiries = []
+        self.expiry_timer = None
+        # Players that finished loading this frame, to look up all at once on the next.
+        self.pending_loaded = []
+
+        # Silences issued on other servers sharing the database come in through here.
+        self.server_id = uuid.uuid4().hex
+        self.silence_listener = SilenceListener(self.db, SILENCES_CHANNEL, self.handle_silence_update)
+        self.silence_listener.start()
+
+        # Chat token buckets by client ID. Each message takes a token, and tokens come
+        # back at qlx_silenceFloodRate per second up to qlx_silenceFloodBurst.
+        self.flood_settings = None
+        self.flood_settings_time = 0
+        self.flood_tokens = array.array("d", [0.0] * 64)
+        self.flood_last = array.array("d", [0.0] * 64)
+        self.flood_strikes = array.array("I", [0] * 64)
+        self.flood_messages = 0
+        self.flood_silences = 0
     
     def handle_player_loaded(self, player):
-        silenced = self.is_silenced(player.steam_id)
-        if not silenced:
-            return
+        # On map change everyone loads at about the same time, so gather them up.
+        if not self.pending_loaded:
+            self.check_loaded()
+        self.pending_loaded.append(player)
 
-        expires, score, reason = silenced
-        self.silenced[player.steam_id] = (expires, score, reason)
-        player.mute()
-        if reason:
-            player.tell("You are muted on this server until ^6{}^7: {}".format(expires, reason))
-        else:
-            player.tell("You are muted on this server until ^6{}^7.".format(expires))
+    @minqlx.next_frame
+    def check_loaded(self):
+        """Look up the silences of the players that loaded since the last frame in two round trips."""
+        players, self.pending_loaded = self.pending_loaded, []
+        silences = self.fetch_silences(list(set(p.steam_id for p in players)))
+        for player in players:
+            silenced = silences.get(player.steam_id)
+            if not silenced:
+                continue
+
+            expires, score, reason = silenced
+            self.add_silenced(player.steam_id, expires, score, reason)
+            try:
+                player.mute()
+            except minqlx.NonexistentPlayerError:
+                continue
+            if reason:
+                player.tell("You are muted on this server until ^6{}^7: {}".format(expires, reason))
+            else:
+                player.tell("You are muted on this server until ^6{}^7.".format(expires))
 
     def handle_player_disconnect(self, player, reason):
+        self.flood_last[player.id] = 0
+        self.flood_strikes[player.id] = 0
         if player.steam_id in self.silenced:
             del self.silenced[player.steam_id]
 
+    def handle_unload(self, plugin):
+        if plugin == self.__class__.__name__:
+            self.silence_listener.stop()
+            if self.expiry_timer:
+                self.expiry_timer.cancel()
+
+    def handle_silence_update(self, data):
+        """Called by the listener thread when a server silences or unsilences someone."""
+        server_id, steam_id = data.split()
+        if server_id != self.server_id:
+            steam_id = int(steam_id)
+            self.apply_silence(steam_id, self.is_silenced(steam_id))
+
     def handle_client_command(self, player, cmd):
         if player.steam_id not in self.silenced:
+            if self.get_flood_settings()[0]:
+                return self.check_flood(player, cmd)
             return
         
-        if (cmd.lower().startswith("say ") or cmd.lower().startswith("say_team ")):
+        lower = cmd[:9].lower()
+        if lower.startswith("say ") or lower.startswith("say_team "):
             expires, score, reason = self.silenced[player.steam_id]
             if time.time() < score:
                 if reason:
@@ -113,41 +186,11 @@ class silence(minqlx.Plugin):
         else:
             reason = ""
         
-        r = LENGTH_REGEX.match(" ".join(msg[2:4]).lower())
-        if r:
-            number = float(r.group("number"))
-            if number <= 0: return
-            scale = r.group("scale").rstrip("s")
-            td = None
-            
-            if scale == "second":
-                td = datetime.timedelta(seconds=number)
-            elif scale == "minute":
-                td = datetime.timedelta(minutes=number)
-            elif scale == "hour":
-                td = datetime.timedelta(hours=number)
-            elif scale == "day":
-                td = datetime.timedelta(days=number)
-            elif scale == "week":
-                td = datetime.timedelta(weeks=number)
-            elif scale == "month":
-                td = datetime.timedelta(days=number * 30)
-            elif scale == "year":
-                td = datetime.timedelta(weeks=number * 52)
-            
-            now = datetime.datetime.now().strftime(TIME_FORMAT)
-            expires = (datetime.datetime.now() + td).strftime(TIME_FORMAT)
-            base_key = PLAYER_KEY.format(ident) + ":silences"
-            silence_id = self.db.zcard(base_key)
-            score = time.time() + td.total_seconds()
-            db = self.db.pipeline()
-            db.zadd(base_key, score, silence_id)
-            silence = {"expires": expires, "reason": reason, "issued": now, "issued_by": player.steam_id}
-            db.hmset(base_key + ":{}".format(silence_id), silence)
-            db.execute()
-
+        td = self.parse_length(" ".join(msg[2:4]))
+        if td:
+            expires, score = self.write_silence(ident, td, reason, player.steam_id)
             if target_player:
-                self.silenced[ident] = (expires, score, reason)
+                self.add_silenced(ident, expires, score, reason)
                 try:
                     target_player.mute()
                 except ValueError:
@@ -187,6 +230,7 @@ class silence(minqlx.Plugin):
             db = self.db.pipeline()
             for silence_id, score in silences:
                 db.zincrby(base_key, silence_id, -score)
+            db.publish(SILENCES_CHANNEL, "{} {}".format(self.server_id, ident))
             db.execute()
             if ident in self.silenced:
                 del self.silenced[ident]
@@ -194,6 +238,25 @@ class silence(minqlx.Plugin):
                 target_player.unmute()
             channel.reply("^6{}^7 has been unsilenced.".format(name))
 
+    def cmd_floodstats(self, player, msg, channel):
+        """Shows the chat token buckets of the players on the server, for tuning the flood cvars."""
+        enabled, rate, burst, length = self.get_flood_settings()
+        if not enabled:
+            channel.reply("^7Flood detection is off. Set ^6qlx_silenceFlood^7 to ^61^7 to turn it on.")
+            return
+
+        channel.reply("^7Tokens come back at ^6{}^7 per second up to ^6{}^7. Floods are silenced for ^6{}^7 seconds."
+            .format(rate, burst, length))
+        channel.reply("^7Seen ^6{}^7 messages and silenced ^6{}^7 floods since the plugin was loaded."
+            .format(self.flood_messages, self.flood_silences))
+        now = time.time()
+        for p in self.players():
+            if not self.flood_last[p.id]:
+                continue
+            tokens = min(burst, self.flood_tokens[p.id] + (now - self.flood_last[p.id]) * rate)
+            channel.reply("  ^6{}^7: ^6{}^7 tokens, silenced ^6{}^7 times"
+                .format(p.name, round(tokens, 1), self.flood_strikes[p.id]))
+
     def cmd_checksilence(self, player, msg, channel):
         """Checks whether a player has been silenced, and if so, why."""
         if len(msg) < 2:
@@ -233,16 +296,218 @@ class silence(minqlx.Plugin):
     #                               HELPERS
     # ====================================================================
 
-    def is_silenced(self, steam_id):
-        base_key = PLAYER_KEY.format(steam_id) + ":silences"
-        silences = self.db.zrangebyscore(base_key, time.time(), "+inf", withscores=True)
-        if not silences:
+    def add_silenced(self, steam_id, expires, score, reason):
+        self.silenced[steam_id] = (expires, score, reason)
+        # Entries of players that left or were unsilenced are only dropped as they come
+        # up, so start over if there are a lot of those.
+        if len(self.expiries) > 2 * len(self.silenced) + 64:
+            self.expiries = [(silence[1], sid) for sid, silence in self.silenced.items()]
+            heapq.heapify(self.expiries)
+        else:
+            heapq.heappush(self.expiries, (score, steam_id))
+        if self.expiries[0][1] == steam_id:
+            self.schedule_expiry()
+
+    def schedule_expiry(self):
+        """Set the timer to go off when the first silence ends."""
+        if self.expiry_timer:
+            self.expiry_timer.cancel()
+        if not self.expiries:
+            self.expiry_timer = None
+            return
+
+        delay = min(MAX_TIMER, max(0, self.expiries[0][0] - time.time()))
+        self.expiry_timer = threading.Timer(delay, self.expire_silences)
+        self.expiry_timer.daemon = True
+        self.expiry_timer.start()
+
+    @minqlx.next_frame
+    def expire_silences(self):
+        """Unmute the players whose silence has ended."""
+        now = time.time()
+        while self.expiries and self.expiries[0][0] <= now:
+            score, steam_id = heapq.heappop(self.expiries)
+            # Skip entries that were replaced or removed since.
+            if steam_id not in self.silenced or self.silenced[steam_id][1] != score:
+                continue
+
+            del self.silenced[steam_id]
+            player = self.player(steam_id)
+            if player:
+                player.unmute()
+                player.tell("Your silence has expired. You can chat again.")
+
+        self.schedule_expiry()
+
+    def parse_length(self, text):
+        """Turn something like "2 weeks" into a timedelta, or None if it can't."""
+        r = LENGTH_REGEX.match(text.lower())
+        if not r:
             return None
 
-        silence_id, score = silences[-1]
-        longest_silence = self.db.hgetall(base_key + ":{}".format(silence_id))
-        expires = datetime.datetime.strptime(longest_silence["expires"], TIME_FORMAT)
-        if (expires - datetime.datetime.now()).total_seconds() > 0:
-            return expires, score, longest_silence["reason"]
-        
-        return None
+        number = float(r.group("number"))
+        if number <= 0:
+            return None
+        scale = r.group("scale").rstrip("s")
+
+        if scale == "second":
+            return datetime.timedelta(seconds=number)
+        elif scale == "minute":
+            return datetime.timedelta(minutes=number)
+        elif scale == "hour":
+            return datetime.timedelta(hours=number)
+        elif scale == "day":
+            return datetime.timedelta(days=number)
+        elif scale == "week":
+            return datetime.timedelta(weeks=number)
+        elif scale == "month":
+            return datetime.timedelta(days=number * 30)
+        elif scale == "year":
+            return datetime.timedelta(weeks=number * 52)
+
+    def write_silence(self, steam_id, td, reason, issued_by):
+        """Store a new silence and tell the other servers about it. Returns the
+        expiration date and the score it got."""
+        now = datetime.datetime.now().strftime(TIME_FORMAT)
+        expires = (datetime.datetime.now() + td).strftime(TIME_FORMAT)
+        base_key = PLAYER_KEY.format(steam_id) + ":silences"
+        silence_id = self.db.zcard(base_key)
+        score = time.time() + td.total_seconds()
+        db = self.db.pipeline()
+        db.zadd(base_key, score, silence_id)
+        silence = {"expires": expires, "reason": reason, "issued": now, "issued_by": issued_by}
+        db.hmset(base_key + ":{}".format(silence_id), silence)
+        db.publish(SILENCES_CHANNEL, "{} {}".format(self.server_id, steam_id))
+        db.execute()
+        return expires, score
+
+    def get_flood_settings(self):
+        """Get the flood cvars, only reading them again every now and then."""
+        if self.flood_settings is None or time.time() - self.flood_settings_time > CVAR_REFRESH:
+            self.flood_settings = (self.get_cvar("qlx_silenceFlood", bool),
+                self.get_cvar("qlx_silenceFloodRate", float),
+                self.get_cvar("qlx_silenceFloodBurst", float),
+                self.get_cvar("qlx_silenceFloodLength", int))
+            self.flood_settings_time = time.time()
+
+        return self.flood_settings
+
+    def check_flood(self, player, cmd):
+        """Take a token from the player's bucket if the command is chat, and silence
+        them for a while if there are none left."""
+        lower = cmd[:9].lower()
+        if not (lower.startswith("say ") or lower.startswith("say_team ")):
+            return
+
+        enabled, rate, burst, length = self.flood_settings
+        cid = player.id
+        now = time.time()
+        self.flood_messages += 1
+        if self.flood_last[cid]:
+            tokens = min(burst, self.flood_tokens[cid] + (now - self.flood_last[cid]) * rate)
+        else:
+            tokens = burst
+        self.flood_last[cid] = now
+        if tokens >= 1:
+            self.flood_tokens[cid] = tokens - 1
+            return
+        self.flood_tokens[cid] = tokens
+
+        if self.db.has_permission(player, 2):
+            return
+
+        # Each flood gets a longer silence than the last.
+        self.flood_strikes[cid] += 1
+        self.flood_silences += 1
+        reason = "Flooding the chat."
+        expires, score = self.write_silence(player.steam_id,
+            datetime.timedelta(seconds=length * self.flood_strikes[cid]), reason, 0)
+        self.add_silenced(player.steam_id, expires, score, reason)
+        player.mute()
+        player.tell("You are muted on this server until ^6{}^7: {}".format(expires, reason))
+        return minqlx.RET_STOP_ALL
+
+    @minqlx.next_frame
+    def apply_silence(self, steam_id, silenced):
+        """Mute or unmute a player on this server after a change made elsewhere."""
+        player = self.player(steam_id)
+        if not player:
+            return
+
+        if silenced:
+            expires, score, reason = silenced
+            self.add_silenced(steam_id, expires, score, reason)
+            player.mute()
+            if reason:
+                player.tell("You have been muted on this server until ^6{}^7: {}".format(expires, reason))
+            else:
+                player.tell("You have been muted on this server until ^6{}^7.".format(expires))
+        elif steam_id in self.silenced:
+            del self.silenced[steam_id]
+            player.unmute()
+
+    def is_silenced(self, steam_id):
+        return self.fetch_silences([steam_id]).get(steam_id)
+
+    def fetch_silences(self, steam_ids):
+        """Get the expiration date, score and reason of the longest active silence of each
+        player that has one, in two round trips no matter how many there are."""
+        now = time.time()
+        db = self.db.pipeline()
+        for steam_id in steam_ids:
+            db.zrangebyscore(PLAYER_KEY.format(steam_id) + ":silences", now, "+inf", withscores=True)
+        latest = [(steam_id, silences[-1]) for steam_id, silences in zip(steam_ids, db.execute()) if silences]
+        if not latest:
+            return {}
+
+        for steam_id, (silence_id, score) in latest:
+            db.hgetall(PLAYER_KEY.format(steam_id) + ":silences:{}".format(silence_id))
+        res = {}
+        for (steam_id, (silence_id, score)), longest_silence in zip(latest, db.execute()):
+            if not longest_silence:
+                continue
+            expires = datetime.datetime.strptime(longest_silence["expires"], TIME_FORMAT)
+            if (expires - datetime.datetime.now()).total_seconds() > 0:
+                res[steam_id] = (expires, score, longest_silence["reason"])
+
+        return res
+
+
+
+# ====================================================================
+#                          SILENCE LISTENER
+# ====================================================================
+
+class SilenceListener(threading.Thread):
+    """Listens on a channel for silences and unsilences made by any server sharing the
+    database, handing each message to the handler. Reconnects on its own if the connection drops.
+
+    """
+    def __init__(self, db, channel, handler):
+        super().__init__(daemon=True)
+        self.db = db
+        self.channel = channel
+        self.handler = handler
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            pubsub = self.db.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                while not self.stop_event.is_set():
+                    message = pubsub.get_message(timeout=1)
+                    if not message:
+                        continue
+                    try:
+                        self.handler(message["data"])
+                    except Exception:
+                        minqlx.log_exception()
+            except Exception:
+                minqlx.log_exception()
+                self.stop_event.wait(LISTEN_RETRY)
+            finally:
+                pubsub.close()
+
+    def stop(self):
+        self.stop_event.set()